@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+"""
+Import-time check for each console script, using python -X importtime.
+
+    python benchmarks/bench_imports.py [--repeat 5] [--budget-ms 150]
+
+Each entry point is timed in a fresh interpreter, importing what it would.
+The exit status is 1 if any exceeds its budget or loads a module it shouldn't
+(requests for local-only paths), so this can gate changes to imports.
+"""
+import argparse
+import os, os.path
+import re
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+sample_json = '{"format": {"filename": "a.mkv", "duration": "60", "bit_rate": "1000000", "size": "1"}, "streams": []}'
+
+# name: (code, stdin, modules not to load)
+entry_points = {
+    'insert_screencap_defaults': (
+        'import sys; sys.argv = ["insert_screencap_defaults"]\n'
+        'from screencap.cli import insert_screencap_defaults; insert_screencap_defaults(verbose=False)',
+        sample_json, ['requests', 'urllib3', 'sqlite3', 'screencap.playlist']),
+    'screencap (video)': (
+        'import screencap.cli, screencap.ffmpeg, screencap.ffprobe',
+        None, ['requests', 'urllib3', 'screencap.playlist']),
+    'screencap (playlist)': (
+        'import screencap.cli, screencap.ffmpeg, screencap.ffprobe, screencap.playlist',
+        None, ['requests', 'urllib3']),
+    'm3usplit': (
+        'import screencap.cli, screencap.splitter',
+        None, ['requests', 'urllib3']),
+    'm3u_by_quality': (
+        'import screencap.cli, screencap.playlist',
+        None, ['requests', 'urllib3']),
+}
+
+line_pattern = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)')
+
+
+def import_times(code, stdin=None):
+    """
+    Returns { module: cumulative microseconds } for top-level imports of code,
+    and the set of every module imported.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root, \
+            input=(stdin or '').encode(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode(errors='replace'))
+    top, loaded = {}, set()
+    for line in proc.stderr.decode().splitlines():
+        m = line_pattern.match(line)
+        if not m:
+            continue
+        _, cumulative, indent, name = m.groups()
+        loaded.add(name)
+        if len(indent) == 1:
+            top[name] = int(cumulative)
+    return top, loaded
+
+
+def measure(code, stdin=None, repeat=5):
+    """
+    Best-of-repeat total import time (ms) of code, excluding interpreter
+    startup (site), and the modules it loaded.
+    """
+    best, loaded = None, set()
+    for _ in range(repeat):
+        top, loaded = import_times(code, stdin)
+        total = sum(us for name, us in top.items() if name != 'site')/1E3
+        best = total if (best is None) else min(best, total)
+    return best, loaded
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=150.)
+    options = parser.parse_args(args)
+    failed = False
+    print('%-28s %10s  %s' % ('entry point', 'ms', 'unwanted modules'))
+    for name, (code, stdin, forbidden) in entry_points.items():
+        ms, loaded = measure(code, stdin, repeat=options.repeat)
+        unwanted = sorted(m for m in forbidden if m in loaded)
+        if unwanted or (options.budget_ms < ms):
+            failed = True
+        print('%-28s %10.1f  %s' % (name, ms, ' '.join(unwanted)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
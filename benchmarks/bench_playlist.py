@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+"""
+Micro-benchmarks for the pure-Python playlist paths, on synthetic playlists.
+
+    python benchmarks/bench_playlist.py [--sizes 1000 10000 100000] [--remote 0.5]
+
+For each size, reports wall time and peak traced memory of each stage:
+tokenizing, building the Playlist, grouping by host, ingesting canned ffprobe
+JSON (no ffprobe needed), sorting by video_quality_key and writing m3u.
+"""
+import argparse
+import json
+import logging
+import os, os.path
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from screencap.cli import video_quality_key
+from screencap.m3u import Playlist, read_playlist
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def make_playlist_lines(n, remote_fraction=0.5, hosts=40, files=None, seed=1):
+    """
+    Yields m3u lines for n entries, a mix of local files and URLs, with
+    EXTINF, VLC start/stop options and scenes sharing input files.
+    """
+    rng = random.Random(seed)
+    files = files or max(1, n//5)
+    yield '#EXTM3U'
+    for i in range(n):
+        f = rng.randrange(files)
+        start = rng.randrange(0, 3000)
+        yield '#EXTINF:%d,Artist %d,Scene %d' % (rng.randrange(30, 600), f, i)
+        yield '#EXTVLCOPT:start-time=%d.%03d' % (start, rng.randrange(1000))
+        yield '#EXTVLCOPT:stop-time=%d' % (start+rng.randrange(10, 600))
+        if rng.random() < remote_fraction:
+            yield 'http://host%02d.example.com:8080/videos/folder %d/file-%06d.mp4' % (f % hosts, f % 7, f)
+        else:
+            yield '/srv/videos/folder %d/file-%06d.mkv' % (f % 7, f)
+
+
+def make_profile(filename, rng):
+    """
+    ffprobe -show_format -show_streams -show_chapters -show_data_hash output
+    """
+    width, height = rng.choice([ (640, 360), (1280, 720), (1920, 1080), (3840, 2160) ])
+    return { 'format': { 'filename': filename,
+                         'duration': '%.6f' % rng.uniform(60, 7200),
+                         'bit_rate': str(rng.randrange(500000, 40000000)),
+                         'size': str(rng.randrange(10**7, 10**10)),
+                         'tags': { 'title': os.path.basename(filename) } },
+             'streams': [ { 'index': 0, 'codec_type': 'video', 'codec_name': 'h264',
+                            'width': width, 'height': height, 'avg_frame_rate': '30000/1001',
+                            'bit_rate': str(rng.randrange(500000, 30000000)),
+                            'extradata_hash': 'SHA256:%064x' % rng.getrandbits(256) },
+                          { 'index': 1, 'codec_type': 'audio', 'codec_name': 'aac',
+                            'tags': { 'language': 'eng' },
+                            'extradata_hash': 'SHA256:%064x' % rng.getrandbits(256) } ],
+             'chapters': [ { 'id': i, 'start_time': '%d' % (60*i) } for i in range(3, 0, -1) ] }
+
+
+def measure(label, func, results, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+    begin = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter()-begin
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        peak = None
+    results.append((label, elapsed, peak))
+    return value
+
+
+def run_stages(path, trace_memory=False):
+    results = []
+    def m(label, func):
+        return measure(label, func, results, trace_memory=trace_memory)
+    m('read_playlist', lambda: sum(1 for _ in read_playlist(path)))
+    playlist = m('Playlist.from_iterable', lambda: Playlist(path))
+    m('Playlist.by_host', lambda: sum(len(es) for _, _, es in playlist.by_host()))
+    rng = random.Random(2)
+    canned = {}
+    for e in playlist:
+        k = e.url if e.remote else str(e.path)
+        if k not in canned:
+            canned[k] = json.dumps(make_profile(k, rng))
+    profiles = [ json.loads(canned[e.url if e.remote else str(e.path)]) for e in playlist ]
+    def ingest():
+        for e, d in zip(playlist, profiles):
+            e.update_metadata(d)
+            e['status'] = (None, rng.random() < 0.9)
+    m('PlaylistEntry.update_metadata', ingest)
+    m('sort by video_quality_key', lambda: playlist.sort(key=video_quality_key))
+    m('Playlist.to_m3u', lambda: sum(1 for _ in playlist.to_m3u(verbose=True)))
+    return results
+
+
+def run_size(n, remote_fraction=0.5):
+    """
+    Times each stage, then repeats the stages under tracemalloc (which slows
+    them down) for peak memory.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / 'bench.m3u8'
+        with path.open('w') as fo:
+            for line in make_playlist_lines(n, remote_fraction=remote_fraction):
+                fo.write(line+'\n')
+        timed = run_stages(path)
+        traced = run_stages(path, trace_memory=True)
+    return [ (label, elapsed, peak) for (label, elapsed, _), (_, _, peak) in zip(timed, traced) ]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--remote', type=float, default=0.5, help='fraction of entries that are URLs')
+    options = parser.parse_args(args)
+    print('%8s  %-32s %10s %12s' % ('entries', 'stage', 'seconds', 'peak KiB'))
+    for n in options.sizes:
+        for label, elapsed, peak in run_size(n, remote_fraction=options.remote):
+            print('%8d  %-32s %10.3f %12.0f' % (n, label, elapsed, peak/1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+"""
+Times parse_playlist on a playlist of URLs served by local http.servers, one
+per simulated host, with an ffprobe stand-in that reads the first KiB of each
+URL and prints canned JSON.
+
+    python benchmarks/bench_remote_probe.py [--entries 200] [--hosts 4] [--latency 0.05] [--per-host 1 4 8]
+
+Each server delays its GET responses by --latency seconds. For each
+connections_per_host, reports wall time, entries probed and the most GETs
+any one host served at once, which should not exceed connections_per_host.
+"""
+import argparse
+import http.server
+import logging
+import os, os.path
+from pathlib import Path
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+ffprobe_stand_in = textwrap.dedent('''\
+    import json, sys, urllib.request
+    url = sys.argv[-1]
+    with urllib.request.urlopen(urllib.request.Request(url, headers={ 'Range': 'bytes=0-1023' })) as fi:
+        fi.read()
+    print(json.dumps({ 'format': { 'filename': url, 'duration': '600.000000', 'bit_rate': '4000000',
+                                   'size': '300000000', 'tags': { 'title': url.rsplit('/', 1)[-1] } },
+                       'streams': [ { 'index': 0, 'codec_type': 'video', 'codec_name': 'h264',
+                                      'width': 1920, 'height': 1080,
+                                      'extradata_hash': 'SHA256:%064x' % hash(url) } ] }))
+    ''')
+
+
+class Counter:
+    "GETs in flight on one server, and the most seen at once"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = self.peak = self.total = 0
+    def __enter__(self):
+        with self.lock:
+            self.active += 1
+            self.total += 1
+            self.peak = max(self.peak, self.active)
+    def __exit__(self, *args):
+        with self.lock:
+            self.active -= 1
+
+
+def start_server(folder, latency):
+    counter = Counter()
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(folder), **kwargs)
+        def do_GET(self):
+            with counter:
+                time.sleep(latency)
+                super().do_GET()
+        def log_message(self, *args):
+            pass
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, counter
+
+
+def run(entries, hosts, latency, per_host_values):
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        (folder / 'www').mkdir()
+        files = max(1, entries//hosts)
+        for i in range(files):
+            (folder / 'www' / ('file-%06d.mp4' % i)).write_bytes(os.urandom(4096))
+        ffprobe = folder / 'ffprobe.py'
+        ffprobe.write_text(ffprobe_stand_in)
+        os.environ['FFPROBE'] = '%s %s' % (sys.executable, ffprobe)
+        os.environ['SCREENCAP_NO_CACHE'] = '1'
+        from screencap.playlist import parse_playlist # reads FFPROBE
+        from screencap.util import caches
+        servers = [ start_server(folder / 'www', latency) for _ in range(hosts) ]
+        path = folder / 'bench.m3u'
+        with path.open('w') as fo:
+            fo.write('#EXTM3U\n')
+            for i in range(entries):
+                server, _ = servers[i % hosts]
+                fo.write('#EXTINF:600,Host %d,Entry %d\n' % (i % hosts, i))
+                fo.write('http://127.0.0.1:%d/file-%06d.mp4\n' % (server.server_address[1], i % files))
+        results = []
+        try:
+            for per_host in per_host_values:
+                for _, counter in servers:
+                    counter.peak = counter.total = 0
+                for cache in caches.values():
+                    cache.clear()
+                begin = time.perf_counter()
+                playlist = parse_playlist(str(path), connections_per_host=per_host)
+                elapsed = time.perf_counter()-begin
+                probed = sum(1 for e in playlist if e.get('width', None))
+                results.append((per_host, elapsed, probed, max(c.peak for _, c in servers), \
+                                sum(c.total for _, c in servers)))
+        finally:
+            for server, _ in servers:
+                server.shutdown()
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entries', type=int, default=200)
+    parser.add_argument('--hosts', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each GET is delayed')
+    parser.add_argument('--per-host', type=int, nargs='+', default=[1, 4, 8])
+    options = parser.parse_args(args)
+    print('%8s %10s %8s %10s %8s' % ('per host', 'seconds', 'probed', 'peak/host', 'GETs'))
+    for per_host, elapsed, probed, peak, total in \
+            run(options.entries, options.hosts, options.latency, options.per_host):
+        print('%8d %10.3f %8d %10d %8d' % (per_host, elapsed, probed, peak, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,32 @@
+"""
+Public names are imported on first use (PEP 562), so that each console
+script loads only the modules it needs.
+"""
+import importlib
 
-from .ffmpeg import get_screencap_commands
-from .ffprobe import get_media_profiles, get_media_profile
-from .playlist import parse_playlist, screencap_playlist
-from .splitter import get_splitter
+_lazy_attributes = {
+    'get_screencap_commands':   'ffmpeg',
+    'seek_screencap':           'composite',
+    'get_media_profiles':       'ffprobe',
+    'get_media_profile':        'ffprobe',
+    'parse_playlist':           'playlist',
+    'screencap_playlist':       'playlist',
+    'get_screencap_jobs':       'playlist',
+    'get_splitter':             'splitter',
+}
 
-screencap = get_screencap_commands
+__all__ = sorted(_lazy_attributes)+['screencap']
+
+
+def __getattr__(name):
+    if name == 'screencap':
+        return __getattr__('get_screencap_commands')
+    try:
+        module_name = _lazy_attributes[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module('.'+module_name, __name__), name)
+    globals()[name] = value
+    return value
+def __dir__():
+    return sorted(set(globals())|set(__all__))
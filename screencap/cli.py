@@ -2,44 +2,161 @@
 import logging
 if __debug__:
     logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
 
-from datetime import timedelta
+import argparse
+import atexit
 import os, os.path
 import sys
+import time
 
 import json
 
-from . import *
+# Each entry point imports what it needs, see bench_imports.py
+from . import instrument, labels
+from .jobs import Job, run_jobs, summarize
 from .util import *
 
 
+def positive_int(text):
+    n = int(text)
+    if n < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % text)
+    return n
+def get_parser(description=None, jobs=False):
+    parser = argparse.ArgumentParser(description=description)
+    if jobs:
+        parser.add_argument('--run', action='store_true', \
+                help='run the generated jobs instead of printing a bash script')
+        parser.add_argument('-j', '--jobs', type=positive_int, default=None, metavar='N', \
+                help='with --run, number of jobs at once (default: one per core)')
+        parser.add_argument('--timeout', type=float, default=None, metavar='SECONDS', \
+                help='with --run, stop any job running longer than this')
+        parser.add_argument('--per-device', type=positive_int, default=None, metavar='N', \
+                help='with --run, at most N jobs at once reading or writing each disk')
+        parser.add_argument('--force', action='store_true', \
+                help='remake outputs even if they are up to date')
+    parser.add_argument('--trace', default=None, metavar='FILE', \
+            help='write timings as Chrome trace-event JSON')
+    parser.add_argument('--trace-summary', action='store_true', \
+            help='print a table of timings to stderr when done')
+    parser.add_argument('args', nargs='*', metavar='FILE')
+    return parser
+def parse_args(parser):
+    """
+    Parse sys.argv, turning on instrumentation if asked.
+    """
+    options = parser.parse_args()
+    if options.trace or options.trace_summary:
+        instrument.enable()
+        atexit.register(report_instrumentation, options)
+    return options
+def report_instrumentation(options):
+    if options.trace:
+        instrument.write_chrome_trace(options.trace)
+    if options.trace_summary:
+        for line in instrument.summary():
+            print(line, file=sys.stderr)
+
+
+def run_and_report(jobs, options, callback=None):
+    """
+    Execute jobs per command-line options, passing each result to callback()
+    as it finishes, then summarize to stderr and exit.
+    """
+    results = run_jobs(jobs, nprocs=options.jobs, timeout=options.timeout, \
+            per_device=options.per_device, callback=callback)
+    for line in summarize(results):
+        print(line, file=sys.stderr)
+    sys.exit(0 if all(r.ok for r in results) else 1)
+
+
 def make_screencaps(verbose=__debug__, playlist_extensions='.m3u .m3u8'.split()):
     """
-    Hello
+    Print (or with --run, execute) screencap scripts for videos and playlists
     """
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
-    execname, *args = sys.argv
-    for arg in args:
+    parser = get_parser(make_screencaps.__doc__, jobs=True)
+    parser.add_argument('--single-pass', action='store_true', \
+            help='decode each input of a playlist once for all of its scenes')
+    parser.add_argument('--no-composite', action='store_true', \
+            help='with --run, use screencap.bash even if Pillow is installed')
+    parser.add_argument('--seek', action='store_true', \
+            help='with --run, grab each frame with an input seek instead of decoding the whole input')
+    options = parse_args(parser)
+    from .ffmpeg import get_screencap_commands as screencap
+    from .ffprobe import get_media_profiles
+    in_process = False
+    if options.run and not options.no_composite:
+        from .composite import available as in_process
+    if options.seek and not in_process:
+        warn("--seek needs --run and Pillow, ignored")
+    seek = options.seek and in_process
+    jobs, produced = [], {}
+    videos = [ arg for arg in options.args if splitext(arg)[-1].lower() not in playlist_extensions ]
+    profiles = get_media_profiles(*videos) if videos else {}
+    for arg in options.args:
         _, ext = splitext(arg)
         if ext.lower() in playlist_extensions:
-            screencap_playlist(arg)
+            from .playlist import get_screencap_jobs, parse_playlist, screencap_playlist
+            if options.run:
+                jobs.extend(get_screencap_jobs(parse_playlist(arg), single_pass=options.single_pass, \
+                        produced=produced, in_process=in_process, force=options.force, seek=seek))
+            else:
+                screencap_playlist(arg, single_pass=options.single_pass, force=options.force)
         else:
-            for line in screencap(arg):
-                print(line)
+            md = profiles.get(arg, None)
+            if md and in_process:
+                from .composite import composite_screencap
+                def func(arg=arg, md=labels.insert_screencap_defaults(md)):
+                    return 0 if composite_screencap(arg, os.path.basename(arg)+'.jpeg', md, seek=seek) else 1
+                jobs.append(Job(arg, func=func, paths=[arg]))
+                continue
+            if md:
+                script = '\n'.join(screencap(arg, **labels.insert_screencap_defaults(md)))
+            else:
+                script = '\n'.join(screencap(arg))
+            if options.run:
+                jobs.append(Job(arg, script=script, paths=[arg]))
+            else:
+                print(script)
+    if options.run:
+        def callback(result):
+            if produced:
+                from .playlist import record_outputs
+                record_outputs([result], produced)
+        run_and_report(jobs, options, callback=callback)
 
 
 def make_split_script(verbose=__debug__):
     """
-    Hello
+    Print (or with --run, execute) scripts splitting videos per playlists
     """
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
-    execname, *args = sys.argv
-    for arg in args:
-        for splitter in get_splitter(arg):
-            print(splitter.to_script())
-            print()
+    parser = get_parser(make_split_script.__doc__, jobs=True)
+    parser.add_argument('--scan', choices=['full', 'windows'], default=None, \
+            help='find keyframes by listing all of them once, or by probing around each cut (default: full for files, windows for URLs)')
+    options = parse_args(parser)
+    kwargs = { 'scan': options.scan } if options.scan else {}
+    from .splitter import get_split_script, get_splitter, run_splitters, summarize_splits
+    splitters = []
+    for arg in options.args:
+        for splitter in get_splitter(arg, force=options.force):
+            if options.run:
+                splitters.append(splitter)
+            else:
+                print(get_split_script(splitter, **kwargs))
+                print()
+    if options.run:
+        begin = time.time()
+        results = run_splitters(splitters, nprocs=options.jobs, timeout=options.timeout, \
+                per_device=options.per_device, **kwargs)
+        for line in summarize_splits(results, elapsed=time.time()-begin):
+            print(line, file=sys.stderr)
+        sys.exit(0 if all(r.ok for r in results) else 1)
 
 
 def video_quality_key(e):
@@ -47,39 +164,85 @@ def video_quality_key(e):
     return (not status[1]), -e.get('width', 0), -e.get('bit_rate', 0)
 def sort_playlist(verbose=__debug__, key=video_quality_key):
     """
-    Hello
+    Print playlists sorted best-quality first
     """
     assert callable(key)
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
-    execname, *args = sys.argv
-    for arg in args:
+    parser = get_parser(sort_playlist.__doc__)
+    parser.add_argument('--cached', action='store_true', \
+            help='answer from the library index for playlists unchanged since last indexed')
+    options = parse_args(parser)
+    from .persist import get_library_index
+    index = get_library_index()
+    for arg in options.args:
+        if options.cached and index and index.is_current(arg) and (key is video_quality_key):
+            debug("'%s' from %s", arg, index.filename)
+            from .m3u import M3U_meta, read_playlist
+            parameters = [ t.text for t in read_playlist(arg) if type(t) is M3U_meta ]
+            rows = index.sorted_playlist(arg)
+            print_m3u((row['m3u_verbose' if verbose else 'm3u'] for row in rows), parameters)
+            continue
+        from .playlist import parse_playlist
         pl = parse_playlist(arg)
+        if index:
+            index.put_playlist(arg, pl)
         pl.sort(key=key)
-        for line in pl.to_m3u(verbose=verbose):
-            print(line)
+        print_m3u(('\n'.join(e.to_m3u(verbose=verbose)) for e in pl), \
+                [ text for _, text in pl.parameters ])
+def print_m3u(entries, parameters=()):
+    "Print a playlist: #EXTM3U, #EXT-X parameter lines, then entries"
+    print('#EXTM3U')
+    for text in parameters:
+        print(text)
+    for text in entries:
+        print(text)
+        print()
+def query_library(verbose=__debug__):
+    """
+    Print the best copies of media across every playlist indexed by
+    m3u_by_quality, without parsing or probing
+    """
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    parser = get_parser(query_library.__doc__)
+    parser.add_argument('-n', '--best', type=int, default=1, metavar='N', \
+            help='copies of each to list')
+    parser.add_argument('--by', choices=['content', 'title'], default='content', \
+            help='what counts as a copy: same content hashes, or same title')
+    parser.add_argument('--min-width', type=int, default=None)
+    parser.add_argument('--min-bit-rate', type=int, default=None)
+    parser.add_argument('--codec', default=None, help='video codec, like h264')
+    parser.add_argument('--ok', action='store_true', help='only entries found when checked')
+    parser.add_argument('--playlist', default=None, help='only entries of this playlist')
+    options = parse_args(parser)
+    from .persist import get_library_index
+    index = get_library_index()
+    if index is None:
+        error("No library index")
+        sys.exit(1)
+    where = {}
+    if options.min_width:
+        where['width'] = options.min_width
+    if options.min_bit_rate:
+        where['bit_rate'] = options.min_bit_rate
+    if options.codec:
+        where['video_codec'] = options.codec
+    if options.ok:
+        where['ok'] = 1
+    if options.playlist:
+        where['playlist'] = os.path.abspath(options.playlist)
+    rows = index.best_copies(options.best, keys=options.args, \
+            by='content_key' if (options.by == 'content') else 'title', **where)
+    print_m3u(row['m3u_verbose' if verbose else 'm3u'] for row in rows)
 
 
 def insert_screencap_defaults(verbose=__debug__):
+    """
+    Add screencap labels to ffprobe JSON, from stdin to stdout
+    """
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
-    execname, *args = sys.argv
-    md = json.load(sys.stdin)
-    if 'title' not in md:
-        try:
-            md['title'] = md['format']['tags']['title']
-        except KeyError:
-            pass
-    if not md.get('title', None):
-        md['title'], _ = os.path.splitext(md['format']['filename'])
-    if 'duration_label' not in md:
-        d = timedelta(seconds=float(md['format']['duration']))
-        md['duration_label'] = str(d).strip(' :0')
-    if 'quality_label' not in md:
-        mbit_rate = int(md['format']['bit_rate'])/1E6
-        vts = [ s for s in md['streams'] if s['codec_type'] == 'video' ]
-        mpixels = max(s.get('width', 0)*s.get('height', 0) for s in vts)/1E6
-        md['quality_label'] = '%0.1f Mpx @ %0.1f Mbit' %(mpixels, mbit_rate)
-    if 'size_label' not in md:
-        md['size_label'] = '{:,d} bytes'.format(int(md['format']['size']))
-    print(json.dumps(md, indent=2))
+    parse_args(get_parser(insert_screencap_defaults.__doc__))
+    md = labels.insert_screencap_defaults(json.load(sys.stdin))
+    print(json.dumps(md, indent=2, default=json_default))
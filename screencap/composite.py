@@ -0,0 +1,250 @@
+#! /usr/bin/env python3
+"""
+Tiled screencaps composed in-process: ffmpeg pipes downscaled keyframes as
+raw RGB, then Pillow tiles and labels them and the JPEG is written, JSON
+comment included, in one write. This skips the PNG round trip through
+ImageMagick and the rewrite by wrjpgcom that screencap.bash does.
+
+seek_screencap grabs each frame instead with a fast input seek (-ss before
+-i), a few at a time, rather than decoding the whole input through a select
+filter: about 30 short reads, which suits large files and URLs.
+
+Pillow is optional: without it, available is False and callers fall back to
+screencap.bash.
+"""
+import logging
+logger = logging.getLogger(__name__)
+debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
+
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import io
+import json
+import os, os.path
+from pathlib import Path
+import struct
+import subprocess
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+from . import instrument
+from .util import *
+
+available = Image is not None
+
+ffmpeg_execname = etc_path / 'ffmpeg.bash'
+font_names = [ 'Palatino-Bold', 'DejaVuSans-Bold.ttf', 'DejaVuSans.ttf' ]
+
+
+def get_frame_size(md, n, pixels=2000000):
+    """
+    (width, height) of each of n frames so that together they cover about
+    pixels, keeping the aspect ratio of md's largest video stream.
+    """
+    w, h = 16, 9
+    vss = [ s for s in md.get('streams', []) if s.get('codec_type', None) == 'video' ]
+    if vss:
+        w, h = max( (int(s.get('width', 0) or 0), int(s.get('height', 0) or 0)) for s in vss )
+        if not (w and h):
+            w, h = 16, 9
+    width = 2*int((pixels/n*w/h)**0.5/2)
+    height = 2*int(width*h/w/2)
+    if w < width: # don't enlarge
+        width, height = w - w%2, h - h%2
+    return width, height
+
+
+def read_frames(input_arg, size, n, start=None, duration=None, seconds_between=30):
+    """
+    Yields up to n frames of input_arg as rgb24 bytes of the given size, one
+    keyframe per seconds_between, decoded by a single ffmpeg.
+    """
+    width, height = size
+    frame_size = width*height*3
+    command = [ ffmpeg_execname, '-skip_frame', 'nokey', '-an', '-sn', '-vsync', '0' ]
+    if start:
+        command += [ '-ss', str(start) ]
+    command += [ '-i', input_arg ]
+    if duration:
+        command += [ '-t', str(duration) ]
+    command += [ '-vf', "select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,%s)',scale=%d:%d" \
+                        % (seconds_between, width, height), \
+                 '-frames:v', str(n), '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1' ]
+    with instrument.span('ffmpeg', category='subprocess', command=' '.join(map(str, command))):
+        proc = subprocess.Popen([ str(c) for c in command ], stdin=subprocess.DEVNULL, \
+                stdout=subprocess.PIPE, bufsize=frame_size)
+        try:
+            while True:
+                frame = proc.stdout.read(frame_size)
+                if len(frame) < frame_size:
+                    break
+                yield frame
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+
+def get_seek_times(duration, n=30, start=0):
+    """
+    n times evenly spaced inside (start, start+duration)
+    """
+    step = Decimal(str(duration))/(n+1)
+    return [ Decimal(str(start))+step*i for i in range(1, n+1) ]
+def read_frame_at(input_arg, t, size):
+    """
+    The frame at (or just before) t seconds as rgb24 bytes of the given size,
+    or None.
+    """
+    width, height = size
+    frame_size = width*height*3
+    command = [ ffmpeg_execname, '-noaccurate_seek', '-ss', '%.3f' % t, '-i', input_arg, \
+                '-an', '-sn', '-frames:v', '1', '-vf', 'scale=%d:%d' % (width, height), \
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1' ]
+    proc = run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode or (len(proc.stdout) < frame_size):
+        debug("No frame at %s in %s: %s", t, input_arg, proc.stderr.decode(errors='replace').strip())
+        return None
+    return proc.stdout[:frame_size]
+def seek_frames(input_arg, size, times, nprocs=None):
+    """
+    Yields the frames found at times, grabbed nprocs at a time.
+    """
+    with ThreadPoolExecutor(max_workers=nprocs or os.cpu_count() or 1) as executor:
+        for frame in executor.map(lambda t: read_frame_at(input_arg, t, size), times):
+            if frame:
+                yield frame
+
+
+def get_font(size=28):
+    for name in font_names:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size)
+    except TypeError: # Pillow < 10.1
+        return ImageFont.load_default()
+def label(sheet, md, font=None):
+    """
+    Label the corners of sheet like annotate.bash, on translucent black.
+    """
+    font = font or get_font()
+    title = md.get('title', None) or md.get('format', {}).get('tags', {}).get('title', None)
+    labels = [ (os.path.basename(title) if title else None, 0, 0), \
+               (md.get('quality_label', None), 1, 0), \
+               (md.get('duration_label', None), 0, 1), \
+               (md.get('size_label', None), 1, 1) ]
+    overlay = Image.new('RGBA', sheet.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    for text, right, bottom in labels:
+        if not text:
+            continue
+        left, top, r, b = draw.textbbox((0, 0), text, font=font)
+        w, h = r-left, b-top
+        x = (sheet.width-w) if right else 0
+        y = (sheet.height-h) if bottom else 0
+        draw.rectangle([x, y, x+w, y+h], fill=(0, 0, 0, 128))
+        draw.text((x-left, y-top), text, font=font, fill=(242, 242, 242, 255))
+    return Image.alpha_composite(sheet.convert('RGBA'), overlay).convert('RGB')
+
+
+def to_jpeg(image, comment=None, quality=90):
+    """
+    JPEG bytes of image, with comment in a COM segment right after SOI.
+    """
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=quality, optimize=True)
+    data = buf.getvalue()
+    if comment:
+        c = comment.encode()
+        if len(c) <= 0xFFFD:
+            return data[:2]+b'\xff\xfe'+struct.pack('>H', len(c)+2)+c+data[2:]
+        warn("Comment of %d bytes too long for JPEG", len(c))
+    return data
+
+
+@instrument.traced()
+def composite_screencap(input_arg, output, md, start=None, stop=None, duration=None, \
+        layout='3x10', pixels=2000000, seek=False, nprocs=None):
+    """
+    Make a labelled, tiled screencap of input_arg (a path or URL), as
+    screencap.bash would. md is labelled ffprobe-style metadata (see
+    labels.insert_screencap_defaults). With seek, frames are grabbed by
+    seeking, nprocs at a time (see seek_frames). Returns the output path, or
+    None on failure.
+    """
+    assert available, "Pillow is needed"
+    input_arg = str(input_arg)
+    columns, rows = ( int(x) for x in layout.split('x') )
+    n = columns*rows
+    if duration is None:
+        if stop:
+            duration = Decimal(str(stop))-Decimal(str(start or 0))
+        else: # to the end of the file
+            try:
+                duration = Decimal(str(md['format']['duration']))-Decimal(str(start or 0))
+            except (KeyError, ArithmeticError):
+                duration = None
+    try:
+        seconds_between = '%.3f' % (float(duration)/(n+1))
+    except (TypeError, ValueError):
+        seconds_between = '30'
+    size = get_frame_size(md, n, pixels=pixels)
+    if seek:
+        if duration is None:
+            error("Duration of '%s' unknown", input_arg)
+            return None
+        try: # seeking past the end finds nothing
+            length = Decimal(str(md['format']['duration']))-Decimal(str(start or 0))
+            if 0 < length < Decimal(str(duration)):
+                duration = length
+        except (KeyError, ArithmeticError):
+            pass
+        frames = seek_frames(input_arg, size, get_seek_times(duration, n, start or 0), nprocs=nprocs)
+    else:
+        frames = read_frames(input_arg, size, n, start=start, \
+                duration=(stop and duration), seconds_between=seconds_between)
+    sheet = Image.new('RGB', (size[0]*columns, size[1]*rows))
+    count = 0
+    for i, frame in enumerate(frames):
+        tile = Image.frombytes('RGB', size, frame)
+        sheet.paste(tile, ((i % columns)*size[0], (i // columns)*size[1]))
+        count += 1
+    if not count:
+        error("No frames from '%s'", input_arg)
+        return None
+    if count < n:
+        warn("Only %d of %d frames from '%s'", count, n, input_arg)
+    with instrument.span('composite.encode'):
+        data = to_jpeg(label(sheet, md), json.dumps(md, default=json_default))
+    output = Path(str(output))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    # a crash leaves only the temporary file, never a truncated output
+    part = output.with_name('.'+output.name+'.part')
+    with open(str(part), 'wb') as fo:
+        fo.write(data)
+    os.replace(str(part), str(output))
+    return output
+
+
+def seek_screencap(input_arg, output=None, md=None, \
+        start=None, stop=None, duration=None, \
+        layout='3x10', pixels=2000000, nprocs=None):
+    """
+    composite_screencap with one seek per frame. md is ffprobe-style
+    metadata, labelled here; if omitted, it's probed. start and stop limit
+    captures to a scene.
+    """
+    from .labels import insert_screencap_defaults
+    input_arg = str(input_arg)
+    if md is None:
+        from .ffprobe import get_media_profile
+        md = get_media_profile(input_arg) or {}
+    md = insert_screencap_defaults(md)
+    output = output or md.get('output', None) or input_arg.rsplit('/', 1)[-1]+'.jpeg'
+    return composite_screencap(input_arg, output, md, start=start, stop=stop, duration=duration, \
+            layout=layout, pixels=pixels, seek=True, nprocs=nprocs)
@@ -0,0 +1,45 @@
+#! /usr/bin/env bash
+# Resize, label and comment a tiled screencap
+#
+# Usage:
+#
+# $ annotate.bash intermediate output < json
+# JSON is in ffprobe format. Labels missing from it are filled in by
+# insert_screencap_defaults.
+set -e
+
+intermediate="$1"
+output="$2"
+[[ -s "$intermediate" ]]
+
+declare -a convert_args
+
+json_info=$(jq -c .) # capture stdin and check it
+# whether labelled, then title, quality, duration and size, one per line
+jq_labels='has("quality_label"), (.title? // .format.tags?.title? // ""), (.quality_label? // ""), (.duration_label? // ""), (.size_label? // "")'
+mapfile -t labels < <(jq -r "$jq_labels" <<< "$json_info")
+if [[ ${labels[0]} != true ]]; then
+  json_info=$(insert_screencap_defaults <<< "$json_info")
+  mapfile -t labels < <(jq -r "$jq_labels" <<< "$json_info")
+fi
+
+[[ ${labels[1]} ]] &&
+  convert_args+=( -gravity northwest -annotate +0+0 "$(basename "${labels[1]}")" )
+[[ ${labels[2]} ]] &&
+  convert_args+=( -gravity northeast -annotate +0+0 "${labels[2]}" )
+[[ ${labels[3]} ]] &&
+  convert_args+=( -gravity southwest -annotate +0+0 "${labels[3]}" )
+[[ ${labels[4]} ]] &&
+  convert_args+=( -gravity southeast -annotate +0+0 "${labels[4]}" )
+
+output_folder=$(dirname "$output")
+[[ $output_folder ]] && [[ -d "$output_folder" ]] || mkdir -p "$output_folder"
+convert "$intermediate" -resize '2000000@>' \
+  -fill gray95 -undercolor '#00000080' \
+  -font Palatino-Bold -pointsize 28 -antialias \
+  "${convert_args[@]}" "$output"
+if type wrjpgcom &> /dev/null; then
+  commented="$(mktemp -t XXXXXXXX.jpeg)"
+  wrjpgcom -comment "$json_info" < "$output" > "$commented"
+  [[ -s "$commented" ]] && mv "$commented" "$output"
+fi
@@ -11,9 +11,12 @@
 # $ screencap file < json
 # Annotations are extracted from json format
 #
-# $ screencap file [ffmpeg options]
+# $ screencap -- [ffmpeg options] -i file [ffmpeg options]
 # This allows fine-tuning ffmpeg parameters
 #
+# JSON which already has labels (see screencap.labels) is used as-is;
+# otherwise they're added by insert_screencap_defaults.
+#
 # Variables observed:
 #  duration			Override detection of video duration
 #  edit_from		Specify a file to hold JSON probe results and edit it
@@ -33,7 +36,7 @@ if [[ -t 2 ]]; then
   FFPROBE="${FFPROBE} -loglevel warning"
 fi
 
-declare -a convert_args ffmpeg_args
+declare -a ffmpeg_args
 
 # defaults
 # This ffmpeg isn't happy doing 4K video tiled beyond n=30
@@ -42,7 +45,7 @@ while getopts "ei:s:" flag
 do
   case "$flag" in
     e) edit_from="$(mktemp -t XXXXXXXX.json)" ;;
-	i) ;; # pass through for ffmpeg compatibility
+	i) input_path="$OPTARG" ;;
     s) layout="$OPTARG" ;;
     :)
       echo "Usage: -$flag requires an argument"
@@ -54,21 +57,25 @@ do
 done >&2
 shift $((OPTIND-1))
 
-ffmpeg_args+=( -i )
-if [[ $# -eq 1 ]]; then
-  input_path="$@"
-  [[ -f "$input_path" ]]
-  ffmpeg_args+=( "${input_path}" )
-else
-  ffmpeg_args+=( "$@" )
-fi
+case $# in
+  0) # screencap -i file
+    ffmpeg_args+=( -i "$input_path" ) ;;
+  1) # screencap file
+    input_path="$1"
+    [[ -f "$input_path" ]]
+    ffmpeg_args+=( -i "$input_path" ) ;;
+  *) # screencap -- [ffmpeg options] -i file [ffmpeg options]
+    ffmpeg_args+=( "$@" ) ;;
+esac
 
 
 if [[ -t 0 ]]; then
   [[ -s $input_path ]] && probe_json=$($FFPROBE -show_format -show_streams -show_chapters -print_format json "$input_path")
 else
   probe_json=$(jq -c .) # capture stdin and check it
-  input_path=$(jq -r ".format.filename?" <<< "$probe_json")
+  # One jq for everything needed from JSON that was labelled in-process
+  mapfile -t fields < <(jq -r '(.format.filename? // ""), has("quality_label"), (.format.duration? | tonumber? // "")' <<< "$probe_json")
+  input_path="${fields[0]}"
 fi
 
 if [[ $edit_from ]]; then
@@ -77,23 +84,17 @@ if [[ $edit_from ]]; then
   fi
   $VISUAL "$edit_from"
   json_info=$(jq -c . < "$edit_from")
+elif [[ ${fields[1]} == true ]]; then
+  json_info="$probe_json"
+  [[ $duration ]] || duration="${fields[2]}"
 else
+  # Fallback, for JSON without labels
   json_info=$(insert_screencap_defaults <<< "$probe_json")
 fi
 
 [[ $output ]] || output="${input_path##*/}.jpeg"
 # duration is needed to calculate interval between screen captures
-[[ $duration ]] || duration=$(jq ".format.duration? | tonumber" <<< "$json_info")
-
-title=$(jq -r '.title? // .format.tags?.title?' <<< "$json_info") && title=$(basename "$title")
-[[ $title != null ]] &&
-  convert_args+=( -gravity northwest -annotate +0+0 "$title" )
-quality_label=$(jq -r '.quality_label?' <<< "$json_info") &&
-  convert_args+=( -gravity northeast -annotate +0+0 "$quality_label" )
-duration_label=$(jq -r ".duration_label?" <<< "$json_info") &&
-  convert_args+=( -gravity southwest -annotate +0+0 "$duration_label" )
-file_size_label=$(jq -r ".size_label?" <<< "$json_info") &&
-  convert_args+=( -gravity southeast -annotate +0+0 "$file_size_label" )
+[[ $duration ]] || duration=$(jq ".format.duration? | tonumber? // empty" <<< "$json_info")
 
 if ! [[ $seconds_between ]]; then
   [[ $duration ]] && seconds_between=$(awk "BEGIN {print ${duration-900} / 31}")
@@ -103,15 +104,5 @@ if $FFMPEG -skip_frame nokey -an -vsync 0 -y "${ffmpeg_args[@]}" \
   -frames:v 1 \
   "$intermediate"
 then
-  [[ -s "$intermediate" ]]
-  output_folder=$(dirname "$output")
-  [[ $output_folder ]] && [[ -d "$output_folder" ]] || mkdir -p "$output_folder"
-  convert "$intermediate" -resize '2000000@>' \
-    -fill gray95 -undercolor '#00000080' \
-    -font Palatino-Bold -pointsize 28 -antialias \
-    "${convert_args[@]}" "$output"
-  if type wrjpgcom &> /dev/null; then
-    wrjpgcom -comment "$json_info" < "$output" > t
-	[[ -s t ]] && mv t "$output"
-  fi
+  "$(dirname "$0")/annotate.bash" "$intermediate" "$output" <<< "$json_info"
 fi
@@ -3,12 +3,16 @@ import logging
 logger = logging.getLogger(__name__)
 debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 import json
 import os, os.path
 from pathlib import Path
+import shutil
 import subprocess
 import sys
-import tempfile
+import time
 
 from .util import *
 
@@ -17,49 +21,199 @@ ffmpeg_execname = etc_path / 'ffmpeg.bash'
 
 arrow = '>' # '\u21e8'
 
+def get_part_path(output):
+    "Temporary name, in the same folder and format, to write output as"
+    output = Path(str(output))
+    return output.with_name('.%s.part%s' % (output.stem, output.suffix))
 class FFMpegConverter:
     execname = etc_path / 'ffmpeg.bash'
     def to_script(self, head='#! /usr/bin/env bash\nset -e\n', **kwargs):
         return head+'\n'.join(self.get_commands(**kwargs))+'\n'
 class FFMpegSplitter(FFMpegConverter):
-    def __init__(self, entries):
+    """
+    Cuts scenes out of one file or URL with stream copy. Each segment seeks
+    the input (-ss before -i) to the keyframe at or before its start, so
+    nothing is decoded and only the needed byte ranges of a URL are read.
+    Segments of the same input are extracted concurrently, each to a
+    temporary file renamed to its output_path once ffmpeg succeeds.
+    """
+    def __init__(self, entries, nprocs=4):
         def start_stop_key(e):
             return e.get('start-time', 0), e.get('stop-time', 1E6)
         self.entries = sorted(entries, key=start_stop_key)
+        "All entries expected to have the same input"
+        self.input ,= set(str(e.url if e.remote else e.path) for e in self.entries)
+        self.input_path = self.input
+        self.input_filename ,= set(e.filename for e in self.entries)
+        self.nprocs = nprocs
+    @property
+    def paths(self):
+        return [ e.path for e in self.entries ]+[ e['output_path'] for e in self.entries ]
+    def get_segments(self, at_keyframes='before', scan='windows'):
+        """
+        Returns [ (entry, arguments for ffmpeg) ], writing to get_part_path.
+        With at_keyframes, starts are moved back to a keyframe (found with
+        get_key_frames), so that copied segments don't begin with
+        undecodable frames.
+        """
+        from .keyframes import get_key_frames
+        starts = [ e.get('start-time', None) for e in self.entries ]
+        if at_keyframes and any(starts):
+            ts = [ t for t in starts if t ]
+            try:
+                found = iter(get_key_frames(self.input, scan=scan).find_many(ts))
+                starts = [ (next(found).timestamp if t else t) for t in starts ]
+            except (ValueError, OSError, subprocess.CalledProcessError) as e:
+                # ffmpeg still seeks to a keyframe, just not a known one
+                warn("Keyframes of '%s' not found: %s", self.input, getattr(e, 'stderr', None) or e)
+        segments = []
+        for e, begin in zip(self.entries, starts):
+            end = e.get('stop-time', None)
+            args = []
+            if begin:
+                args += [ '-ss', str(begin) ]
+            args += [ '-i', self.input ]
+            if end:
+                args += [ '-t', str(Decimal(str(end))-Decimal(str(begin or 0))) ]
+            args += [ '-map', '0', '-codec', 'copy', '-avoid_negative_ts', 'make_zero', \
+                      '-y', str(get_part_path(e['output_path'])) ]
+            segments.append((e, args))
+        return segments
     def get_commands(self, **kwargs):
         "Generate lines of sh code"
+        makeme = set()
         for e in self.entries:
             op = Path(e['output_path']).parent
             if not op.is_dir():
                 makeme.add(op)
-        if len(makeme):
-            yield 'mkdir -p '+' '.join(sq(d) for d in makeme)
-        for e in self.entries:
-            begin, end = entry.get('start-time', None), entry.get('stop-time', None)
-            if begin or end:
-                line = '{0.execname} -i {1}'.format(self, e.remote or e.path)
-                if begin:
-                    line += ' -ss {!s}'.format(begin)
-                if end:
-                    line += ' -to {!s}'.format(end)
-                line += ' -codec copy {output_path} || echo "{output_path} failed!" >&2'.format(**e)
-                yield line
-        local_files = list(filter(None, (e.path for e in entries)))
+        if makeme:
+            yield 'mkdir -p '+' '.join(sq(d) for d in sorted(makeme))
+        for n, (e, args) in enumerate(self.get_segments(**kwargs), start=1):
+            yield '%s %s && mv -f %s %s || echo %s >&2 &' % (sq(self.execname), ' '.join(sq(a) for a in args), \
+                    sq(get_part_path(e['output_path'])), sq(e['output_path']), \
+                    sq('%s failed!' % e['output_path']))
+            if not (n % self.nprocs):
+                yield 'wait'
+        yield 'wait'
+        local_files = [ e.path for e in self.entries if e.path ]
         if local_files:
             yield 'mkdir -p delme covers'
-            yield 'mv -i -t delme '+' '.join(sq(f) for f in local_files)
+            yield 'mv -i -t delme '+' '.join(sorted(set(sq(f) for f in local_files)))
+    def run(self, timeout=None, cleanup=True, **kwargs):
+        """
+        Split without a shell, returning a mkvmerge.SplitResult. With cleanup,
+        a fully split local input is moved into delme/.
+        """
+        from .mkvmerge import SplitResult
+        begin = time.time()
+        local = not self.entries[0].remote
+        input_size = os.path.getsize(self.input) if local else \
+                (self.entries[0].get('file_size', 0) or 0)
+        for e in self.entries:
+            Path(e['output_path']).parent.mkdir(parents=True, exist_ok=True)
+        def extract(segment):
+            e, args = segment
+            output = Path(e['output_path'])
+            part = get_part_path(output)
+            try:
+                proc = run([self.execname]+args, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc = None
+            size = part.stat().st_size if part.exists() else 0
+            if (proc is None) or proc.returncode or not size:
+                if part.exists():
+                    part.unlink()
+                if proc is None:
+                    return output, None, 'timed out after %s s' % timeout
+                return output, None, 'ffmpeg exited with %d' % proc.returncode
+            os.replace(str(part), str(output))
+            return output, size, ''
+        outputs, messages = collections.OrderedDict(), []
+        with ThreadPoolExecutor(max_workers=self.nprocs) as executor:
+            for output, size, message in executor.map(extract, self.get_segments(**kwargs)):
+                if message:
+                    error("%s failed: %s", output, message)
+                    messages.append(message)
+                outputs[output] = size
+        result = SplitResult(self.input, input_size, outputs, 1 if messages else 0, \
+                time.time()-begin, '; '.join(messages))
+        if cleanup and local and result.ok:
+            for d in ('covers', 'delme'):
+                os.makedirs(d, exist_ok=True)
+            shutil.move(self.input, 'delme')
+        return result
+
 
 screencap_execname = etc_path / 'screencap.bash'
 assert screencap_execname.exists()
 
-def get_screencap_commands(*input_args, head='#! /usr/bin/env bash\nset -e\n', **kwargs):
+def get_screencap_commands(*input_args, head='#! /usr/bin/env bash\nset -e\n', output=None, **kwargs):
+    """
+    Generate lines of sh code running screencap.bash. Keyword arguments are
+    passed as its JSON; labelled JSON (see labels.insert_screencap_defaults)
+    saves it starting Python again.
+    """
     assert input_args
     command = [sq(screencap_execname)]+[ sq(a) for a in input_args ]
+    if output:
+        command.insert(0, 'output=%s' % sq(output))
     yield head
     if kwargs:
         d = kwargs
         yield ' '.join(command)+" << 'EOF'"
-        yield json.dumps(d, indent=2)
+        yield json.dumps(d, indent=2, default=json_default)
         yield 'EOF'
     else:
         yield ' '.join(command)
+
+
+annotate_execname = etc_path / 'annotate.bash'
+assert annotate_execname.exists()
+
+def get_scenes_screencap_commands(input_arg, scenes, layout='3x10', \
+        head='#! /usr/bin/env bash\nset -e\n'):
+    """
+    Generate lines of sh code making one screencap per scene of input_arg
+    while decoding it only once. Each scene is a dict with 'output' and
+    optionally 'start-time', 'stop-time', 'duration' and 'metadata' (JSON for
+    annotate.bash).
+
+    One ffmpeg reads the span covering all scenes and splits the (keyframe
+    only) video into a select and tile branch per scene.
+    """
+    assert scenes
+    starts = [ Decimal(str(s.get('start-time', 0) or 0)) for s in scenes ]
+    stops = [ s.get('stop-time', None) for s in scenes ]
+    first = min(starts)
+    last = max(Decimal(str(t)) for t in stops) if all(stops) else None
+    n = len(scenes)
+    graph = [ '[0:v]split=%d%s' % (n, ''.join('[v%d]' % i for i in range(n))) ]
+    outputs = []
+    for i, (scene, start, stop) in enumerate(zip(scenes, starts, stops)):
+        duration = scene.get('duration', None) or ((Decimal(str(stop))-start) if stop else None)
+        seconds_between = '%.3f' % (Decimal(str(duration))/31) if duration else '30'
+        condition = "gte(t\\,%s)" % start
+        if stop:
+            condition = "between(t\\,%s\\,%s)" % (start, stop)
+        graph.append("[v%d]select='%s*(isnan(prev_selected_t)+gte(t-prev_selected_t\\,%s))',tile=%s[o%d]" \
+                % (i, condition, seconds_between, layout, i))
+        outputs += [ '-map', "'[o%d]'" % i, '-frames:v', '1', '"$scenes_folder"/%03d.png' % i ]
+    yield head
+    yield 'scenes_folder="$(mktemp -d)"'
+    command = [ sq(ffmpeg_execname), '-skip_frame', 'nokey', '-an', '-vsync', '0', '-y' ]
+    if first:
+        command += [ '-ss', str(first), '-copyts' ]
+    if last:
+        command += [ '-t', str(last-first) ]
+    command += [ '-i', sq(input_arg), '-filter_complex', sq(';'.join(graph)) ]
+    yield ' '.join(command+outputs)
+    for i, scene in enumerate(scenes):
+        line = '%s "$scenes_folder"/%03d.png %s' % (sq(annotate_execname), i, sq(scene['output']))
+        md = scene.get('metadata', None)
+        if md:
+            yield line+" << 'EOF' || echo %s >&2" % sq('%s failed!' % scene['output'])
+            yield json.dumps(md, indent=2, default=json_default)
+            yield 'EOF'
+        else:
+            yield line+' < /dev/null || echo %s >&2' % sq('%s failed!' % scene['output'])
+    yield 'rm -r "$scenes_folder"'
@@ -4,43 +4,157 @@ logger = logging.getLogger(__name__)
 debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
 
 import collections
-import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import itertools
 import json
+import os
+import shlex
 import subprocess
+import threading
+import urllib.parse
 
+from . import instrument
+from .persist import get_content_index, get_profile_cache
 from .util import *
 
-media_profiler_execname = etc_path / 'json_media_info.bash'
-assert media_profiler_execname.exists()
+
+ffprobe_command = shlex.split(os.environ.get('FFPROBE', 'ffprobe'))
+ffprobe_options = '-loglevel error -show_format -show_streams -show_chapters -show_data_hash SHA256 -print_format json'.split()
+# For URLs: stop after the first 2 MB or 2 s of streams, so only headers are fetched
+remote_ffprobe_options = '-probesize 2000000 -analyzeduration 2000000'.split()
 
 
 class FFProbeHash(collections.namedtuple('ExtraDataHash', 'types value')):
     def __str__(self):
         return '%s:%X' %(':'.join(self.types), self.value)
+class ProbeResult(collections.namedtuple('ProbeResult', 'filename profile error')):
+    pass
+
+
+def content_key(d):
+    """
+    Identity of media regardless of its path or URL: a digest of the streams'
+    extradata hashes, duration and size. None if ffprobe gave no hashes.
+    """
+    hashes = sorted(s['extradata_hash'] for s in d.get('streams', ()) if s.get('extradata_hash', None))
+    if not hashes:
+        return None
+    f = d.get('format', {})
+    parts = [ str(f.get('duration', '')), str(f.get('size', '')) ]+hashes
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def probe(arg, options=None):
+    """
+    Run ffprobe on one file or URL, returning a ProbeResult.
+    """
+    filename = str(arg)
+    if options is None:
+        options = remote_ffprobe_options if ('://' in filename) else []
+    proc = run(ffprobe_command+list(options)+ffprobe_options+[filename], \
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        lines = proc.stderr.decode(errors='replace').strip().splitlines()
+        return ProbeResult(filename, None, lines[-1] if lines else 'ffprobe exited with %d' % proc.returncode)
+    try:
+        return ProbeResult(filename, json.loads(proc.stdout.decode()), None)
+    except ValueError as e:
+        return ProbeResult(filename, None, 'Invalid ffprobe output: %s' % e)
+def iter_probes(args, nprocs=None, per_host=4, **kwargs):
+    """
+    Probe several files concurrently, yielding ProbeResults as each finishes.
+    URLs are limited to per_host probes at once on each host.
+    """
+    hosts = collections.OrderedDict() # host: [ args ]
+    for a in map(str, args):
+        h = urllib.parse.urlsplit(a).netloc.lower() if ('://' in a) else ''
+        hosts.setdefault(h, []).append((h, a))
+    if not hosts:
+        return
+    limits = { h: threading.BoundedSemaphore(per_host) for h in hosts if h }
+    def worker(host, arg):
+        if not host:
+            return probe(arg, **kwargs)
+        with limits[host]:
+            return probe(arg, **kwargs)
+    # Interleave hosts, so that few workers sit waiting on one host's limit
+    order = [ ha for group in itertools.zip_longest(*hosts.values()) for ha in group if ha ]
+    nprocs = min(len(order), nprocs or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        futures = [ executor.submit(worker, h, a) for h, a in order ]
+        for future in as_completed(futures):
+            yield future.result()
 
 
 def get_media_profile(arg, **kwargs):
     """
     Retrieve a structure of media metadata
     """
-    return get_media_profiles(arg)[str(arg)]
+    return get_media_profiles(arg, **kwargs).get(str(arg), None)
+@instrument.traced()
 def get_media_profiles(*args, refresh=False, \
-        cache=Cache(), deepcopy=copy.deepcopy, \
+        cache=Cache('media_profiles', maxsize=100000, maxbytes=1<<30), persistent=True, \
+        errors=None, nprocs=None, \
         **kwargs):
-    def media_profiler(*args, **kwargs):
-        proc = run([media_profiler_execname]+list(args), \
-                stdout=subprocess.PIPE)
-        assert proc.returncode == 0
-        d = json.loads(proc.stdout.decode())
-        for arg in args:
-            if arg not in d:
-                error("'%s' skipped", arg)
-        return d
+    """
+    Retrieve { filename: metadata } for several files at once.
+
+    Local files are also looked up in the on-disk ProfileCache, and URLs in
+    the ContentIndex, unless persistent=False. refresh=True ignores these
+    caches and probes again.
+    Files ffprobe fails on are left out; pass a dict as errors to collect
+    { filename: message } for them.
+
+    Profiles are shared with the cache, so they're read-only (see freeze()).
+    """
     args = [ str(a) for a in args ]
-    not_found = set(args)
-    if (cache is not None) and not refresh:
-        not_found -= set(cache)
+    if cache is None:
+        cache = {}
+    results = {}
+    if not refresh:
+        for k in set(args):
+            d = cache.get(k, None)
+            if d is not None:
+                results[k] = d
+    not_found = set(args)-set(results)
+    store = get_profile_cache() if persistent else None
+    if (store is not None) and not_found and not refresh:
+        found = store.get_many(f for f in not_found if '://' not in f)
+        if found:
+            debug("%d profiles from %s", len(found), store.filename)
+            for k, d in found.items():
+                results[k] = cache[k] = freeze(d)
+            instrument.count('profiles from disk cache', len(found))
+            not_found -= set(found)
+    index = get_content_index() if persistent else None
+    if (index is not None) and not_found and not refresh:
+        # URLs already seen, maybe as another path or URL of the same content
+        found = index.get_profiles(f for f in not_found if '://' in f)
+        if found:
+            debug("%d profiles from %s", len(found), index.filename)
+            for k, d in found.items():
+                results[k] = cache[k] = freeze(d)
+            instrument.count('profiles from content index', len(found))
+            not_found -= set(found)
     if not_found:
         debug("Reading "+', '.join("'%s'" % f for f in not_found))
-        cache.update(media_profiler(*not_found, **kwargs))
-    return { k: copy.deepcopy(cache[k]) for k in args }
+        probed = {}
+        for filename, d, message in iter_probes(sorted(not_found), nprocs=nprocs, **kwargs):
+            if message:
+                error("'%s' skipped: %s", filename, message)
+                if errors is not None:
+                    errors[filename] = message
+                continue
+            results[filename] = cache[filename] = freeze(d)
+            instrument.count('files probed')
+            try:
+                instrument.count('bytes probed', int(d['format']['size']))
+            except (KeyError, ValueError):
+                pass
+            probed[filename] = d
+        if (store is not None) and probed:
+            store.put_many({ k: d for k, d in probed.items() if '://' not in k })
+        if (index is not None) and probed:
+            index.put_many(probed)
+    return { k: results[k] for k in args if k in results }
@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+"""
+Timing spans and counters, for finding where a run spends its time.
+
+Nothing is recorded until enable() is called. Results can be written as
+Chrome trace-event JSON (load in chrome://tracing or Perfetto) or a summary
+table.
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+enabled = False
+events = [] # (name, category, begin, duration, thread id, args)
+counters = collections.Counter()
+lock = threading.Lock()
+origin = time.perf_counter()
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+@contextlib.contextmanager
+def span(name, category='screencap', **args):
+    """
+    Record the time spent inside a with block.
+    """
+    if not enabled:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with lock:
+            events.append((name, category, begin-origin, end-begin, threading.get_ident(), args))
+def traced(name=None, category='screencap'):
+    """
+    Decorator recording a span for each call.
+    """
+    def decorator(func):
+        label = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label, category=category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    if enabled:
+        with lock:
+            counters[name] += n
+
+
+def to_chrome_trace():
+    pid = os.getpid()
+    trace_events = [ { 'name': name, 'cat': category, 'ph': 'X', \
+                       'ts': begin*1E6, 'dur': duration*1E6, \
+                       'pid': pid, 'tid': tid, \
+                       'args': { k: str(v) for k, v in args.items() } } \
+                     for name, category, begin, duration, tid, args in events ]
+    end = time.perf_counter()-origin
+    trace_events.extend({ 'name': name, 'ph': 'C', 'ts': end*1E6, 'pid': pid, \
+                          'args': { name: value } } \
+                        for name, value in counters.items())
+    return { 'traceEvents': trace_events, 'displayTimeUnit': 'ms' }
+def write_chrome_trace(path):
+    with open(str(path), 'w') as fo:
+        json.dump(to_chrome_trace(), fo)
+
+
+def summary():
+    """
+    Generate lines of a table of spans by name, then counters.
+    """
+    totals = collections.OrderedDict()
+    for name, _, _, duration, _, _ in events:
+        n, total, longest = totals.get(name, (0, 0., 0.))
+        totals[name] = (n+1, total+duration, max(longest, duration))
+    yield '%-40s %8s %10s %10s %10s' % ('span', 'calls', 'total s', 'mean s', 'max s')
+    for name, (n, total, longest) in sorted(totals.items(), key=lambda i: -i[1][1]):
+        yield '%-40s %8d %10.3f %10.3f %10.3f' % (name[:40], n, total, total/n, longest)
+    if counters:
+        yield ''
+        yield '%-40s %8s' % ('counter', 'value')
+        for name, value in sorted(counters.items()):
+            yield '%-40s %8s' % (name[:40], '{:,}'.format(value))
@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+"""
+Run generated jobs from Python with a bounded worker pool, rather than piping
+their scripts into one serial bash.
+"""
+import logging
+logger = logging.getLogger(__name__)
+debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
+
+import collections
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import os, os.path
+import signal
+import subprocess
+import time
+
+
+class JobResult(collections.namedtuple('JobResult', 'name returncode elapsed message')):
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+def get_device(path):
+    """
+    st_dev of the file system holding path, or of its nearest existing
+    parent (for outputs not yet written). None for URLs.
+    """
+    path = str(path)
+    if '://' in path:
+        return None
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+class Job:
+    """
+    A named unit of work: either a bash script or a Python callable returning
+    an exit status. paths are the files it reads and writes, for scheduling
+    by device.
+    """
+    def __init__(self, name, script=None, func=None, paths=()):
+        assert (script is None) != (func is None)
+        self.name, self.script, self.func = str(name), script, func
+        self.paths = [ str(p) for p in paths if p ]
+    @property
+    def devices(self):
+        return frozenset(d for d in map(get_device, self.paths) if d is not None)
+    def __repr__(self):
+        return '<Job %s>' % self.name
+    def __call__(self, timeout=None):
+        begin = time.time()
+        if self.func:
+            try:
+                rc, message = self.func(), ''
+            except Exception as e:
+                rc, message = 1, '%s: %s' % (type(e).__name__, e)
+            return JobResult(self.name, rc or 0, time.time()-begin, message)
+        proc = subprocess.Popen(['bash', '-s'], stdin=subprocess.PIPE, \
+                start_new_session=True)
+        try:
+            proc.communicate(self.script.encode(), timeout=timeout)
+            message = '' if (proc.returncode == 0) else 'exit status %d' % proc.returncode
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+            message = 'timed out after %s s' % timeout
+        return JobResult(self.name, proc.returncode, time.time()-begin, message)
+
+
+def run_jobs(jobs, nprocs=None, timeout=None, per_device=None, callback=None):
+    """
+    Run jobs with up to nprocs at once (default: one per core). Returns
+    JobResults in completion order, passing each to callback() as it comes.
+
+    With per_device, at most that many jobs at once touch any one device
+    (st_dev of their paths), and each device's jobs start in order of their
+    first path (the input read), so one disk isn't thrashed while others idle.
+    """
+    if (per_device is not None) and (per_device < 1):
+        raise ValueError("per_device must be at least 1, not %s" % per_device)
+    jobs = list(jobs)
+    results = []
+    if not jobs:
+        return results
+    nprocs = min(len(jobs), nprocs or os.cpu_count() or 1)
+    if per_device:
+        devices = { job: job.devices for job in jobs }
+        jobs.sort(key=lambda job: job.paths[0] if job.paths else '')
+        info("Running %d jobs on %d devices, %d at a time and %d per device", \
+                len(jobs), len(set().union(*devices.values())), nprocs, per_device)
+    else:
+        devices = collections.defaultdict(frozenset)
+        info("Running %d jobs, %d at a time", len(jobs), nprocs)
+    busy = collections.Counter()
+    pending, running = jobs, {}
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        while pending or running:
+            # Start the first jobs, in input order, whose devices have room
+            i = 0
+            while (len(running) < nprocs) and (i < len(pending)):
+                job = pending[i]
+                if all(busy[d] < per_device for d in devices[job]):
+                    del pending[i]
+                    busy.update(devices[job])
+                    running[executor.submit(job, timeout=timeout)] = job
+                else:
+                    i += 1
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                busy.subtract(devices[running.pop(future)])
+                r = future.result()
+                if r.ok:
+                    debug("%s done in %.1f s", r.name, r.elapsed)
+                else:
+                    error("%s failed: %s", r.name, r.message)
+                results.append(r)
+                if callback:
+                    callback(r)
+    return results
+
+
+def summarize(results):
+    """
+    Generate lines of text describing a batch of JobResults.
+    """
+    failed = [ r for r in results if not r.ok ]
+    total = sum(r.elapsed for r in results)
+    yield '%d jobs, %d succeeded, %d failed, %.1f s of work' % \
+            (len(results), len(results)-len(failed), len(failed), total)
+    for r in failed:
+        yield '  %s: %s' % (r.name, r.message)
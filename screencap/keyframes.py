@@ -3,67 +3,385 @@
 Find closest keyframe to a timestamp or frame number in a video.
 
 Relies on bundled script get_key_frames.bash
+
+Keyframes are held as two parallel arrays (frame numbers and timestamps in
+seconds), sorted once when loaded. If NumPy is installed, find_many() snaps
+a whole list of values in one searchsorted() call.
+
+The text output of get_key_frames.bash is converted once to a binary index
+(the same filename plus '.idx'), which later runs map into memory instead of
+parsing. The index records the size, mtime and stream hashes (content_key) of
+the video it was made from, and is rebuilt when they no longer match.
+
+KeyFrameWindows avoids reading the whole file: it asks ffprobe only for small
+intervals around the times of interest, widening them until a keyframe turns
+up, and remembers what it has seen.
 """
+import logging
+logger = logging.getLogger(__name__)
+debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
 
+from array import array
 import bisect
 from decimal import Decimal
 import collections
+import hashlib
+import json
+import mmap
 import os, os.path
 from pathlib import Path
+import struct
+import sys
 #import subprocess
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import instrument
+from .ffprobe import content_key, ffprobe_command, get_media_profile
+from .persist import get_cache_dir
 from .util import *
 
 execname = etc_path / 'get_key_frames.bash'
 
+index_suffix = '.idx'
+# magic, byte order, version, video size, video mtime_ns, number of rows,
+# video content_key, padded to 56 bytes so that the columns are 8-byte aligned
+index_header = struct.Struct('=7scHQqQ20s2x')
+index_magic = b'SCKEYFR'
+index_version = 3
+no_hash = bytes(20)
+
+def get_source_hash(source):
+    """
+    content_key of a video, as bytes, or no_hash if ffprobe gave no stream
+    hashes.
+    """
+    key = content_key(get_media_profile(source) or {})
+    return bytes.fromhex(key) if key else no_hash
+
 class FramePair(collections.namedtuple('FramePair', 'frame_number timestamp')):
     pass
 
 class KeyFrames:
     def __init__(self, arg, **kwargs):
+        self.frame_numbers, self.timestamps = array('q'), array('d')
         if isinstance(arg, (str, Path)):
             path = self.path = Path(arg)
-            self.load_video(path)
+            self.load_video(path, **kwargs)
         else:
-            self.rows = arg
+            self.extend(arg)
+    def __len__(self):
+        return len(self.timestamps)
+    def __getitem__(self, i):
+        return FramePair(self.frame_numbers[i], Decimal(repr(self.timestamps[i])))
+    @property
+    def rows(self):
+        return [ self[i] for i in range(len(self)) ]
+    def extend(self, rows):
+        """
+        Add (frame_number, timestamp) pairs.
+        """
+        pairs = [ (int(f), float(t)) for f, t in rows ]
+        if not pairs:
+            return
+        pairs.extend(zip(self.frame_numbers, self.timestamps))
+        pairs.sort()
+        self.frame_numbers = array('q', (f for f, _ in pairs))
+        self.timestamps = array('d', (t for _, t in pairs))
+    @instrument.traced('KeyFrames.load_video')
     def load_video(self, input_path, nframes=None, **kwargs):
         assert input_path.exists()
+        for key_frame_filename in [ Path(str(input_path)+'.key_frames'), \
+                                    Path(input_path.name+'.key_frames') ]:
+            if self.load_index(key_frame_filename, source=input_path):
+                return
         if nframes:
             args = [ str(execname), '-n', str(nframes), str(input_path) ]
         else:
             args = [ str(execname), str(input_path) ]
-        proc = run(args, stdout=subprocess.PIPE)
-        assert (0 == proc.returncode)
-        key_frame_filename, _ = proc.stdout.decode().split('\n')
-        rows = self.rows = []
-        y = rows.append
-        with open(key_frame_filename, 'Ur') as fi:
+        for attempt in range(2):
+            proc = run(args, stdout=subprocess.PIPE)
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, args, output=proc.stdout)
+            key_frame_filename, _ = proc.stdout.decode().split('\n')
+            # get_key_frames.bash reuses any list it finds, even one made
+            # before the video changed
+            if attempt or (input_path.stat().st_mtime_ns <= Path(key_frame_filename).stat().st_mtime_ns):
+                break
+            info("Removing %s, older than '%s'", key_frame_filename, input_path)
+            for p in [ key_frame_filename, key_frame_filename+index_suffix ]:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+        if not self.load_index(key_frame_filename, source=input_path):
+            self.load_text(key_frame_filename)
+            self.save_index(key_frame_filename, source=input_path)
+    def load_text(self, key_frame_filename):
+        """
+        Read 'frame_number timestamp' lines, as written by get_key_frames.bash
+        """
+        frame_numbers, timestamps = array('q'), array('d')
+        with open(key_frame_filename) as fi:
             for line in fi:
                 if not line.strip():
                     continue
                 f, t = line.split()
-                y( FramePair(int(f), Decimal(t)) )
-        rows.sort()
-    def find(self, value, direction=-1):
-        rows = self.rows
+                frame_numbers.append(int(f))
+                timestamps.append(float(t))
+        if any(b < a for a, b in zip(timestamps, timestamps[1:])):
+            self.extend(zip(frame_numbers, timestamps))
+        else:
+            self.frame_numbers, self.timestamps = frame_numbers, timestamps
+    def load_index(self, key_frame_filename, source=None):
+        """
+        Map a binary index into memory. Returns False if it's missing, older
+        than the text file it was made from, of another version, or made from
+        a video of another size, mtime or content_key than source.
+        """
+        index_path = Path(str(key_frame_filename)+index_suffix)
+        try:
+            if index_path.stat().st_mtime < Path(key_frame_filename).stat().st_mtime:
+                return False
+            with index_path.open('rb') as fi:
+                m = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, byteorder, version, size, mtime_ns, n, source_hash = index_header.unpack_from(m)
+        except (OSError, ValueError, struct.error):
+            return False
+        if (magic, byteorder, version) != (index_magic, sys.byteorder[0].encode(), index_version) \
+                or len(m) != index_header.size+16*n:
+            warn("Ignoring invalid index %s", index_path)
+            return False
+        if source is not None:
+            st = os.stat(str(source))
+            if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+                debug("%s was made from another version of '%s'", index_path, source)
+                return False
+            current_hash = get_source_hash(source)
+            if (no_hash not in (source_hash, current_hash)) and (source_hash != current_hash):
+                debug("%s was made from other streams than '%s'", index_path, source)
+                return False
+        view = memoryview(m)[index_header.size:]
+        self.frame_numbers = view[:8*n].cast('q')
+        self.timestamps = view[8*n:].cast('d')
+        return True
+    def save_index(self, key_frame_filename, source=None):
+        index_path = Path(str(key_frame_filename)+index_suffix)
+        temp_path = index_path.with_name(index_path.name+'.tmp')
+        size, mtime_ns, source_hash = 0, 0, no_hash
+        if source is not None:
+            st = os.stat(str(source))
+            size, mtime_ns, source_hash = st.st_size, st.st_mtime_ns, get_source_hash(source)
+        try:
+            with temp_path.open('wb') as fo:
+                fo.write(index_header.pack(index_magic, sys.byteorder[0].encode(), index_version, \
+                        size, mtime_ns, len(self), source_hash))
+                fo.write(array('q', self.frame_numbers).tobytes())
+                fo.write(array('d', self.timestamps).tobytes())
+            os.replace(str(temp_path), str(index_path))
+        except OSError as e:
+            warn("Could not write %s: %s", index_path, e)
+            return False
+        return True
+    def _column(self, value):
+        """
+        Returns the array to search for this kind of value, and the value
+        converted to that array's type.
+        """
         if isinstance(value, int):
-            keys = [ row.frame_number for row in rows ]
             assert (1 <= value), "Frame numbers start at 1"
-        elif isinstance(value, Decimal):
-            keys = [ row.timestamp for row in rows ]
+            return self.frame_numbers, value
+        elif isinstance(value, (Decimal, float)):
+            return self.timestamps, float(value)
         elif isinstance(value, str):
-            value = Decimal(value)
-            keys = [ row.timestamp for row in rows ]
-        else:
-            raise ValueError("Invalid parameter %s" % value)
+            return self.timestamps, float(Decimal(value))
+        raise ValueError("Invalid parameter %s" % value)
+    def _index(self, i, value, direction):
         if (-1 == direction): # rightmost less than or equal to arg
-            i = bisect.bisect_right(keys, value)
             if i:
-                return rows[i-1]
+                return i-1
             raise ValueError("No frames before %s" % value)
         elif (1 == direction): # leftmost greater than or equal to
-            i = bisect.bisect_left(keys, value)
-            if i < len(rows):
-                return rows[i]
+            if i < len(self):
+                return i
             raise ValueError("No frames after %s" % value)
         raise ValueError("Invalid parameter %s" % direction)
+    def find(self, value, direction=-1):
+        keys, v = self._column(value)
+        if (-1 == direction):
+            i = bisect.bisect_right(keys, v)
+        else:
+            i = bisect.bisect_left(keys, v)
+        return self[self._index(i, value, direction)]
+    def find_many(self, values, direction=-1):
+        """
+        Like find() for each of values, in order.
+        """
+        values = list(values)
+        if not values:
+            return []
+        columns = [ self._column(v) for v in values ]
+        keys = columns[0][0]
+        if (numpy is None) or any(k is not keys for k, _ in columns):
+            return [ self.find(v, direction=direction) for v in values ]
+        side = 'right' if (-1 == direction) else 'left'
+        dtype = numpy.int64 if (keys is self.frame_numbers) else numpy.float64
+        found = numpy.searchsorted(numpy.frombuffer(keys, dtype=dtype), \
+                numpy.array([ v for _, v in columns ], dtype=dtype), side=side)
+        return [ self[self._index(int(i), value, direction)] \
+                for i, value in zip(found, values) ]
+
+
+class KeyFrameWindows:
+    """
+    Keyframe timestamps near a few points of a video, found by probing only
+    intervals around those points. Frame numbers are not known, so results
+    are FramePairs with frame_number=None and only timestamps can be looked
+    up.
+
+    Windows start at `window` seconds either side and double, up to
+    `max_window`, until a keyframe is found on the needed side.
+    """
+    def __init__(self, arg, window=4, max_window=4096, cache=True):
+        self.input = str(arg)
+        self.window, self.max_window = window, max_window
+        self.timestamps, self.intervals = [], []
+        self.cache_path = self.get_cache_path() if cache else None
+        if self.cache_path and self.cache_path.exists():
+            try:
+                with self.cache_path.open() as fi:
+                    d = json.load(fi)
+                self.timestamps, self.intervals = d['timestamps'], d['intervals']
+            except (OSError, ValueError, KeyError) as e:
+                warn("Ignoring %s: %s", self.cache_path, e)
+    def get_cache_path(self):
+        if '://' in self.input:
+            ident = hashlib.sha1(self.input.encode()).hexdigest()
+        else:
+            try:
+                st = os.stat(self.input)
+            except OSError:
+                return None
+            ident = '%d-%d' % (st.st_size, st.st_mtime_ns)
+        name = clean_filename(self.input.rsplit('/', 1)[-1])
+        return get_cache_dir() / 'key_frames' / ('%s-%s.windows.json' % (ident, name))
+    def save(self):
+        if not self.cache_path:
+            return
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.cache_path.with_name(self.cache_path.name+'.tmp')
+            with temp_path.open('w') as fo:
+                json.dump({ 'timestamps': self.timestamps, 'intervals': self.intervals }, fo)
+            os.replace(str(temp_path), str(self.cache_path))
+        except OSError as e:
+            warn("Could not write %s: %s", self.cache_path, e)
+    @instrument.traced('KeyFrameWindows.probe')
+    def probe(self, intervals):
+        """
+        Read keyframes in each (start, end) interval with one ffprobe call.
+        Raises subprocess.CalledProcessError, with ffprobe's stderr, if it
+        fails (say, on an unreachable URL).
+        """
+        intervals = [ (max(0., a), b) for a, b in intervals ]
+        debug("Probing %s for keyframes in %s", self.input, intervals)
+        command = ffprobe_command+[ '-loglevel', 'error', '-select_streams', 'v:0', \
+                '-skip_frame', 'nokey', \
+                '-read_intervals', ','.join('%f%%%f' % iv for iv in intervals), \
+                '-show_entries', 'frame=key_frame,best_effort_timestamp_time', \
+                '-print_format', 'csv=p=0', self.input ]
+        proc = run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, command, \
+                    output=proc.stdout, stderr=proc.stderr.decode(errors='replace').strip())
+        found = set(self.timestamps)
+        for line in proc.stdout.decode().splitlines():
+            k, _, t = line.partition(',')
+            if k.strip() == '1':
+                try:
+                    found.add(float(t))
+                except ValueError:
+                    pass
+        self.timestamps = sorted(found)
+        merged = []
+        for a, b in sorted(self.intervals+[ list(iv) for iv in intervals ]):
+            if merged and (a <= merged[-1][1]):
+                merged[-1][1] = max(merged[-1][1], b)
+            else:
+                merged.append([a, b])
+        self.intervals = merged
+    def _lookup(self, t, direction):
+        """
+        Nearest keyframe timestamp on one side of t, if the probed intervals
+        prove it is the nearest. Otherwise None.
+        """
+        for a, b in self.intervals:
+            if a <= t <= b:
+                break
+        else:
+            return None
+        if (-1 == direction):
+            i = bisect.bisect_right(self.timestamps, t)
+            if i and (a <= self.timestamps[i-1]):
+                return self.timestamps[i-1]
+        elif (1 == direction):
+            i = bisect.bisect_left(self.timestamps, t)
+            if (i < len(self.timestamps)) and (self.timestamps[i] <= b):
+                return self.timestamps[i]
+        else:
+            raise ValueError("Invalid parameter %s" % direction)
+    def find(self, value, direction=-1):
+        return self.find_many([value], direction=direction)[0]
+    def find_many(self, values, direction=-1):
+        """
+        Like KeyFrames.find_many(), for timestamps only.
+        """
+        values = list(values)
+        ts = []
+        for value in values:
+            if isinstance(value, str):
+                value = Decimal(value)
+            if not isinstance(value, (Decimal, float)):
+                raise ValueError("Invalid parameter %s" % value)
+            ts.append(float(value))
+        found = [ self._lookup(t, direction) for t in ts ]
+        window, probed = self.window, False
+        while any(f is None for f in found):
+            pending = [ t for t, f in zip(ts, found) if f is None ]
+            if self.max_window < window:
+                raise ValueError("No frames %s %s within %s s" % \
+                        ('before' if (-1 == direction) else 'after', pending[0], self.max_window))
+            if (-1 == direction):
+                for t in pending:
+                    if any((a <= 0) and (t <= b) for a, b in self.intervals):
+                        raise ValueError("No frames before %s" % t)
+                self.probe([ (t-window, t+1) for t in pending ])
+            else:
+                self.probe([ (t-1, t+window) for t in pending ])
+            probed = True
+            found = [ f if (f is not None) else self._lookup(t, direction) \
+                    for t, f in zip(ts, found) ]
+            window *= 2
+        if probed:
+            self.save()
+        return [ FramePair(None, Decimal(repr(f))) for f in found ]
+
+
+key_frame_cache = Cache('key_frames', maxsize=64)
+def get_key_frames(arg, scan='full', **kwargs):
+    """
+    Shared KeyFrames (scan='full') or KeyFrameWindows (scan='windows') for a
+    video, kept in key_frame_cache.
+    """
+    key = (str(arg), scan)
+    keyframes = key_frame_cache.get(key, None)
+    if keyframes is None:
+        if scan == 'windows':
+            keyframes = KeyFrameWindows(arg, **kwargs)
+        else:
+            keyframes = KeyFrames(arg, **kwargs)
+        key_frame_cache[key] = keyframes
+    return keyframes
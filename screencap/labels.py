@@ -0,0 +1,55 @@
+#! /usr/bin/env python3
+"""
+Corner labels for screencaps, from ffprobe JSON. This is the in-process
+version of the insert_screencap_defaults script, so that screencap.bash
+doesn't start Python (and jq) again for every file.
+"""
+import logging
+logger = logging.getLogger(__name__)
+debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
+
+import os, os.path
+
+from .util import *
+
+
+def get_screencap_labels(md):
+    """
+    Returns { 'title': ..., 'duration_label': ..., 'quality_label': ...,
+    'size_label': ... } for labels missing from md that can be computed.
+    """
+    labels = {}
+    f = md.get('format', {})
+    if 'title' not in md:
+        title = f.get('tags', {}).get('title', None)
+        if not title and f.get('filename', None):
+            title, _ = os.path.splitext(f['filename'])
+        if title:
+            labels['title'] = title
+    if 'duration_label' not in md:
+        try:
+            labels['duration_label'] = time_s(f['duration'])
+        except (KeyError, TypeError, ValueError):
+            pass
+    if 'quality_label' not in md:
+        try:
+            mbit_rate = int(f['bit_rate'])/1E6
+            vts = [ s for s in md.get('streams', []) if s.get('codec_type', None) == 'video' ]
+            mpixels = max((s.get('width', 0) or 0)*(s.get('height', 0) or 0) for s in vts)/1E6
+            labels['quality_label'] = '%0.1f Mpx @ %0.1f Mbit' %(mpixels, mbit_rate)
+        except (KeyError, TypeError, ValueError):
+            pass
+    if 'size_label' not in md:
+        try:
+            labels['size_label'] = '{:,d} bytes'.format(int(f['size']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return labels
+def insert_screencap_defaults(md):
+    """
+    Returns a new dict of md (which may be a frozen profile) with labels
+    added.
+    """
+    d = dict(md)
+    d.update(get_screencap_labels(md))
+    return d
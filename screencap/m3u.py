@@ -3,14 +3,17 @@ import logging
 logger = logging.getLogger(__name__)
 debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
 
-import collections
+import codecs
+import collections, collections.abc
 from decimal import Decimal
+import io
 import itertools
+import mmap
 from pathlib import Path
 import shlex
 import urllib.parse
 
-from .ffprobe import get_media_profile, get_media_profiles, FFProbeHash
+from .ffprobe import content_key, get_media_profile, get_media_profiles, FFProbeHash
 from .util import *
 
 """
@@ -91,27 +94,75 @@ class M3U_GRP(M3U_meta):
         return s.strip().capitalize()
 
 
-def read_playlist(arg, mode='rU'):
+def sniff_encoding(path, head=b''):
+    """
+    Guess a playlist's encoding from its name and first bytes. m3u8 files are
+    UTF-8; legacy m3u files are taken as UTF-8 if they decode cleanly,
+    otherwise Latin-1.
+    """
+    for bom, encoding in [ (codecs.BOM_UTF8, 'utf-8-sig'), \
+                           (codecs.BOM_UTF16_LE, 'utf-16'), \
+                           (codecs.BOM_UTF16_BE, 'utf-16') ]:
+        if head.startswith(bom):
+            return encoding
+    if str(path).lower().endswith('.m3u8'):
+        return 'utf-8'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def iter_lines(path, encoding=None, sniff_size=1<<16, fallback='latin-1'):
+    """
+    Yields the text lines of a file, reading through a memory map.
+
+    Lines are decoded one at a time, so that a UTF-8 playlist with legacy
+    bytes beyond the sniffed head still reads: those lines are decoded as
+    fallback instead, with a warning.
+    """
+    with open(str(path), 'rb') as fi:
+        try:
+            m = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return
+        with m:
+            encoding = encoding or sniff_encoding(path, m[:sniff_size])
+            if encoding == 'utf-16': # not line-separable as bytes
+                yield from io.TextIOWrapper(fi, encoding=encoding)
+                return
+            warned = False
+            for lineno, line in enumerate(iter(m.readline, b''), start=1):
+                try:
+                    yield line.decode(encoding)
+                except UnicodeDecodeError:
+                    if not warned:
+                        warn("'%s' line %d isn't %s, reading such lines as %s", path, lineno, encoding, fallback)
+                        warned = True
+                    yield line.decode(fallback)
+
+
+def read_playlist(arg, encoding=None):
     """
     Returns a sequence of tokens, in file order.
 
-    Note that m3u files have several encodings; m3u8 files are UTF-8.
+    Lines are read and tokenized one at a time. Note that m3u files have
+    several encodings; m3u8 files are UTF-8. See sniff_encoding().
     """
     if isinstance(arg, (Path, str)):
         path = Path(arg)
         folder = path.parent
-        with path.open(mode) as fi:
-            lines = [ line.strip() for line in fi ]
+        lines = iter_lines(path, encoding=encoding)
     else:
         folder = None
-        lines = [ line.strip() for line in arg ]
-    lines = list(filter(None, lines))
-    if not lines:
-        error("Empty file")
-        raise StopIteration()
-    for lineno, line in enumerate(lines, start=1):
+        lines = arg
+    lineno = 0
+    for line in lines:
+        line = line.strip()
         if not line:
             continue
+        lineno += 1
         if line.startswith('#'):
             if line.startswith('#EXTM3U'):
                 yield FileHeader(line, lineno)
@@ -130,50 +181,79 @@ def read_playlist(arg, mode='rU'):
             yield RemoteFile(line, lineno=lineno)
         else:
             yield LocalFile(line, lineno=lineno, folder=folder)
+    if not lineno:
+        error("Empty file")
 
 
 class Playlist(HasTitle, HasEntries):
     """
     .header         usually #EXTM3U
     .entries        entries in file order
+
+    With lazy=True, nothing is read until iter_entries() or from_iterable().
     """
-    def __init__(self, arg, **kwargs):
+    def __init__(self, arg, lazy=False, **kwargs):
         HasTitle.__init__(self, **kwargs)
         HasEntries.__init__(self, **kwargs)
         self.header, self.parameters = None, []
+        self.profiles = None
+        self.source = arg
         if isinstance(arg, (str, Path)):
             filename = self.path = Path(arg)
             self.folder = self.path.parent
             self.set_title('playlist_name', self.path.stem)
-            self.from_iterable(read_playlist(self.path))
-        else:
-            self.from_iterable(read_playlist(arg))
-    def _precompute_metadata(self):
+            self.source = self.path
+        if not lazy:
+            self.from_iterable(read_playlist(self.source))
+    def _precompute_metadata(self, remote=False, **kwargs):
         """
-        Parallel-capable batch update of local files' metadata
+        Parallel-capable batch update of local files' metadata. With
+        remote=True, also URLs whose status was found to be ok.
+
+        Results, including which files failed, are kept in .profiles as {
+        path or URL: profile or None }.
         """
-        return get_media_profiles(*set(e.path for e in self.entries if not e.remote))
+        args = set(e.path for e in self.entries if not e.remote)
+        if remote:
+            args.update(e.url for e in self.entries \
+                    if e.remote and e.get('status', (None, False))[1])
+        results = get_media_profiles(*args, **kwargs)
+        if self.profiles is None:
+            self.profiles = {}
+        self.profiles.update(dict.fromkeys(map(str, args)))
+        self.profiles.update(results)
+        return results
     def by_host(self):
         """
         Yields groups of (hostname, True, entries) for remote, or (filename, False, entries) if local.
         """
-        for hostname, es in itertools.groupby(sorted(self.entries, key=host_key), \
-                key=host_key):
+        def key(e):
+            h = host_key(e)
+            return h, (file_key(e) if not h else '')
+        for (hostname, filename), es in itertools.groupby(sorted(self.entries, key=key), \
+                key=key):
             if hostname:
                 yield hostname, True, list(es)
             else:
-                for filename, fes in itertools.groupby(sorted(es, key=file_key), \
-                        key=file_key):
-                    yield filename, False, list(fes)
+                yield filename, False, list(es)
     def from_iterable(self, iterable, start=1):
         """
         Import an iterable of tokens. Only tokens from read_playlist() are supported.
         """
+        self.entries.extend(self.iter_entries(iterable, start=start))
+    def iter_entries(self, iterable=None, start=1):
+        """
+        Yields each PlaylistEntry as soon as its lines have been read, without
+        storing it. Reads the playlist's own file if no tokens are given.
+        """
+        if iterable is None:
+            iterable = read_playlist(self.source)
         groups, comments, vlcopt = \
         [],     [],       KVQ()
         duration, parameters, tags = \
         None,     [],         []
         order = start
+        lineno = 0
         for token in iterable:
             try:
                 lineno = token.lineno
@@ -199,7 +279,7 @@ class Playlist(HasTitle, HasEntries):
                 if comments:
                     entry['comments'], comments = comments, []
                 if groups:
-                    entry['groups'], groups = groups, set()
+                    entry['groups'], groups = groups, []
                 if vlcopt:
                     entry.update(vlcopt)
                     vlcopt = KVQ()
@@ -224,7 +304,7 @@ class Playlist(HasTitle, HasEntries):
                     if stoptime:
                         entry.set_duration(stoptime-starttime)
                 entry.playlist = self
-                self.entries.append(entry)
+                yield entry
                 order += 1
             else:
                 error("Programming error: %s is unexpectedly type %s", token, type(token))
@@ -244,7 +324,37 @@ class Playlist(HasTitle, HasEntries):
                 yield token
 
 
-class PlaylistEntry(HasTitle, HasDuration):
+class PlaylistEntry(HasTitle, HasDuration, collections.abc.MutableMapping):
+    """
+    A mapping of playlist and metadata values. Frequent keys are held in
+    slots; anything else goes in an overflow dict, created when first needed.
+    """
+    slot_names = { # key: attribute
+        'lineno': 'lineno',                 # int
+        'start-time': 'start_time',         # Decimal seconds
+        'stop-time': 'stop_time',           # Decimal seconds
+        'actual_start-time': 'actual_start_time',
+        'actual_stop-time': 'actual_stop_time',
+        'status': 'status',                 # (datetime, bool)
+        'width': 'width',                   # int
+        'height': 'height',                 # int
+        'megapixels': 'megapixels',         # float
+        'bit_rate': 'bit_rate',             # int
+        'file_size': 'file_size',           # int
+        'video_codec': 'video_codec',       # str
+        'audio_codecs': 'audio_codecs',     # [str]
+        'languages': 'languages',           # [str]
+        'avg_frame_rate': 'avg_frame_rate', # str
+        'extradata_hashes': 'extradata_hashes', # [FFProbeHash]
+        'content_key': 'content_key',       # str, see ffprobe.content_key
+        'output_path': 'output_path',       # Path
+        'screens_path': 'screens_path',     # Path
+        'intermediate_filename': 'intermediate_filename',
+        'Artist': 'artist',
+        'Album': 'album',
+        }
+    __slots__ = tuple(slot_names.values())+('_extra', '_ordered_titles', '_ordered_durations', \
+            'path', 'remote', 'playlist', 'file_order')
     def __init__(self, \
             title_default_order='playlist_name'.split(), \
             duration_default_order='from_metadata from_VLCOPT'.split()):
@@ -254,6 +364,57 @@ class PlaylistEntry(HasTitle, HasDuration):
         """
         HasTitle.__init__(self, default_order=title_default_order)
         HasDuration.__init__(self, default_order=duration_default_order)
+        self._extra = None
+        self.path = self.remote = self.playlist = self.file_order = None
+    def __getitem__(self, key):
+        name = self.slot_names.get(key, None)
+        if name:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+    def __setitem__(self, key, value):
+        name = self.slot_names.get(key, None)
+        if name:
+            setattr(self, name, value)
+        elif self._extra is None:
+            self._extra = { key: value }
+        else:
+            self._extra[key] = value
+    def __delitem__(self, key):
+        name = self.slot_names.get(key, None)
+        if name:
+            try:
+                delattr(self, name)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+    def __contains__(self, key):
+        name = self.slot_names.get(key, None)
+        if name:
+            return hasattr(self, name)
+        return (self._extra is not None) and (key in self._extra)
+    def __iter__(self):
+        for key, name in self.slot_names.items():
+            if hasattr(self, name):
+                yield key
+        if self._extra:
+            yield from self._extra
+    def __len__(self):
+        return sum(1 for _ in self)
+    def get(self, key, default=None):
+        name = self.slot_names.get(key, None)
+        if name:
+            return getattr(self, name, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
     def to_m3u(self, verbose=__debug__):
         if verbose:
             yield '# Titles:\t'+' -> '.join(filter(None, self._ordered_titles.values()))
@@ -300,7 +461,7 @@ class PlaylistEntry(HasTitle, HasDuration):
         return d
     def update_metadata(self, d=None):
         """
-        Populate object parts from ffprobe JSON output.
+        Populate object parts from ffprobe JSON output, which is not modified.
         """
         def video_stream_key(stream):
             try:
@@ -314,31 +475,38 @@ class PlaylistEntry(HasTitle, HasDuration):
             return x, y
 
         if d is None:
-            d = get_media_profile(self.remote or self.path)
-        cs = d.pop('chapters', None)
-        f  = d.pop('format', None)
-        ss = d.pop('streams', None)
+            d = get_media_profile(self.url if self.remote else self.path)
+        if not d:
+            warn("No metadata for '%s'", self.url if self.remote else self.path)
+            return
+        cs = d.get('chapters', None)
+        f  = d.get('format', None)
+        ss = d.get('streams', None)
         if cs:
-            cs.sort(key=lambda c: c['id'])
-            self['chapters'] = cs
+            self['chapters'] = sorted(cs, key=lambda c: c['id'])
         if f:
-            if 'tags' in f:
-                t = f['tags'].pop('title', None)
-                if t:
-                    self.set_title('from_metadata', t)
-            self['bit_rate'] = f['bit_rate']
-            dur = f.pop('duration', None)
+            t = f.get('tags', {}).get('title', None)
+            if t:
+                self.set_title('from_metadata', t)
+            try:
+                self['bit_rate'] = int(f['bit_rate'])
+            except (KeyError, ValueError):
+                pass
+            dur = f.get('duration', None)
             if dur:
                 self.set_duration('from_metadata', Decimal(dur))
-            fs = f.pop('size', None)
+            fs = f.get('size', None)
             if fs:
                 self['file_size'] = int(fs)
+        k = content_key(d)
+        if k:
+            self['content_key'] = k
         if ss:
             vss, ass, oss = [], [], []
             hashes = self['extradata_hashes'] = []
             for s in ss:
-                stype = s.pop('codec_type', None)
-                h = s.pop('extradata_hash', None)
+                stype = s.get('codec_type', None)
+                h = s.get('extradata_hash', None)
                 if h:
                     *hash_types, hash_s = h.split(':')
                     hashes.append( FFProbeHash([stype]+hash_types, int(hash_s, 16)) )
@@ -354,21 +522,20 @@ class PlaylistEntry(HasTitle, HasDuration):
             lang = self['languages'] = []
             acs = self['audio_codecs'] = []
             for s in ass:
-                t = s.get('tags', {}).pop('language', '')
+                t = s.get('tags', {}).get('language', '')
                 if t.strip():
                     lang.append(t)
-                acs.append(s.pop('codec_name', None))
-            primary_vs = max(vss, key=video_stream_key)
+                acs.append(s.get('codec_name', None))
+            primary_vs = max(vss, key=video_stream_key, default=None)
             if primary_vs:
-                vss.remove(primary_vs)
-                c = primary_vs.pop('codec_name', None)
+                vss = [ s for s in vss if s is not primary_vs ]
+                c = primary_vs.get('codec_name', None)
                 if c:
                     self['video_codec'] = c
                 for k in 'width height avg_frame_rate nframes'.split():
-                    v = primary_vs.pop(k, None)
+                    v = primary_vs.get(k, None)
                     if v:
                         self[k] = v
-                debug("Unused video stream: %s", s)
                 mp = self.get('width', 0)*self.get('height', 0)
                 if mp:
                     self['megapixels'] = mp/1E6
@@ -379,8 +546,8 @@ class PlaylistEntry(HasTitle, HasDuration):
             for s in oss:
                 debug("Unused stream: %s", s)
 
-
-class LocalFile(PlaylistEntry, KVQ):
+class LocalFile(PlaylistEntry):
+    __slots__ = ('folder',)
     def __init__(self, path, folder=None, **kwargs):
         super().__init__()
         self.remote = None
@@ -396,7 +563,8 @@ class LocalFile(PlaylistEntry, KVQ):
     def to_m3u(self, **kwargs):
         yield from PlaylistEntry.to_m3u(self, **kwargs)
         yield str(self.path)
-class RemoteFile(PlaylistEntry, KVQ):
+class RemoteFile(PlaylistEntry):
+    __slots__ = ()
     def __init__(self, arg=None, **kwargs):
         super().__init__()
         self.remote = None
@@ -8,8 +8,13 @@ import collections
 import json
 import os, os.path
 import shlex
+import shutil
+import subprocess
+import tempfile
+import time
 
-from .keyframes import KeyFrames
+from . import instrument
+from .keyframes import get_key_frames
 from .util import *
 
 def to_json(obj):
@@ -18,8 +23,21 @@ def to_json(obj):
 def sq(arg, **kwargs):
     return shlex.quote(str(arg))
 
+class SplitResult(collections.namedtuple('SplitResult', 'input_path input_size outputs returncode elapsed message')):
+    """
+    outputs is { output_path: bytes written, or None if it failed }
+    """
+    @property
+    def ok(self):
+        return (self.returncode == 0) and all(size is not None for size in self.outputs.values())
+    @property
+    def bytes_written(self):
+        return sum(size or 0 for size in self.outputs.values())
+
+
 class MkvMergeConverter:
     execname = etc_path / 'mkvmerge.bash'
+    @instrument.traced('MkvMergeConverter.to_script')
     def to_script(self, head='#! /usr/bin/env bash\nset -e\n', **kwargs):
         return head+'\n'.join(self.get_commands(**kwargs))+'\n'
 class MkvMergeSplitter(MkvMergeConverter):
@@ -40,7 +58,10 @@ class MkvMergeSplitter(MkvMergeConverter):
         for n, e in enumerate(self.entries, start=1):
             if 'intermediate_filename' not in e:
                e['intermediate_filename'] = pattern % n
-    def get_options(self, at_keyframes='before'):
+    @property
+    def paths(self):
+        return [ self.input_path ]+[ e['output_path'] for e in self.entries ]
+    def get_options(self, at_keyframes='before', scan='full', folder=None):
         def get_timespan(e):
             begin = e.get('start-time', None)
             end = e.get('stop-time', None)
@@ -53,22 +74,28 @@ class MkvMergeSplitter(MkvMergeConverter):
             at_keyframe='before' (the default)
             at_keyframe=None (saves a little time)
             at_keyframe='after' (valid, but useless and wasteful)
+
+        scan='full' lists every keyframe in the file once (and caches it),
+        while scan='windows' only probes around each cut point.
+
+        Parts are written to folder, if given, instead of the current one.
         """
         if at_keyframes:
-            info("Detecting all keyframes for '%s'", self.input_path)
-            keyframes = KeyFrames(self.input_path)
+            if scan == 'windows':
+                info("Detecting keyframes near cuts in '%s'", self.input_path)
+            else:
+                info("Detecting all keyframes for '%s'", self.input_path)
+            keyframes = get_key_frames(self.input_path, scan=scan)
             if 'before' in at_keyframes:
-                for e in self.entries:
-                    if 'start-time' in e:
-                        t = e['start-time']
-                        e['start-time'], e['actual_start-time'] = \
-                                keyframes.find(t).timestamp, t
+                es = [ e for e in self.entries if 'start-time' in e ]
+                ts = [ e['start-time'] for e in es ]
+                for e, t, k in zip(es, ts, keyframes.find_many(ts)):
+                    e['start-time'], e['actual_start-time'] = k.timestamp, t
             if 'after' in at_keyframes:
-                for e in self.entries:
-                    if 'stop-time' in e:
-                        t = e['stop-time']
-                        e['stop-time'], e['actual_stop-time'] = \
-                                keyframes.find(t, direction=1).timestamp, t
+                es = [ e for e in self.entries if 'stop-time' in e ]
+                ts = [ e['stop-time'] for e in es ]
+                for e, t, k in zip(es, ts, keyframes.find_many(ts, direction=1)):
+                    e['stop-time'], e['actual_stop-time'] = k.timestamp, t
         for p, n in zip(self.entries, self.entries[1:]):
             if 'stop-time' in p and 'start-time' in n:
                 if p['stop-time'] > n['start-time']:
@@ -81,7 +108,7 @@ class MkvMergeSplitter(MkvMergeConverter):
                         info("Moving start time %s <- %s", p['stop-time'], n['start-time'])
                         n['start-time'] = p['stop-time']
         return [ '-o'
-               , self.filename_pattern
+               , os.path.join(str(folder), self.filename_pattern) if folder else self.filename_pattern
                , '--link'
                , '--split'
                , 'parts:'+','.join(get_timespan(e) for e in self.entries)
@@ -105,3 +132,47 @@ class MkvMergeSplitter(MkvMergeConverter):
         # custom:
         yield 'mkdir -p covers delme'
         yield 'mv -t delme %s' % sq(self.input_path)
+    @instrument.traced('MkvMergeSplitter.run')
+    def run(self, timeout=None, cleanup=True, **kwargs):
+        """
+        Split without a shell, returning a SplitResult. The options file and
+        parts go to a temporary folder beside the first output, so that
+        splitters of inputs with the same name can run at once. Each part is
+        moved to its output_path if mkvmerge wrote it. With cleanup, a fully
+        split input is moved into delme/, like the script does.
+        """
+        begin = time.time()
+        input_size = os.path.getsize(str(self.input_path))
+        for e in self.entries:
+            Path(e['output_path']).parent.mkdir(parents=True, exist_ok=True)
+        folder = Path(tempfile.mkdtemp(prefix='.split-', dir=str(Path(self.entries[0]['output_path']).parent)))
+        try:
+            options_filename = folder / os.path.basename(self.options_filename)
+            with open(str(options_filename), 'w') as fo:
+                fo.write(to_json(self.get_options(folder=folder, **kwargs)))
+            try:
+                proc = run([self.execname, '@'+str(options_filename)], timeout=timeout)
+                returncode, message = proc.returncode, ''
+                if returncode:
+                    message = 'mkvmerge exited with %d' % returncode
+            except subprocess.TimeoutExpired:
+                returncode, message = -1, 'timed out after %s s' % timeout
+            outputs = collections.OrderedDict()
+            for e in self.entries:
+                intermediate, output = folder / e['intermediate_filename'], Path(e['output_path'])
+                size = intermediate.stat().st_size if intermediate.exists() else 0
+                if (returncode == 0) and size:
+                    shutil.move(str(intermediate), str(output))
+                    outputs[output] = size
+                else:
+                    error("%s failed!", output)
+                    outputs[output] = None
+        finally:
+            shutil.rmtree(str(folder), ignore_errors=True)
+        result = SplitResult(self.input_path, input_size, outputs, returncode, time.time()-begin, message)
+        if cleanup and result.ok:
+            for d in ('covers', 'delme'):
+                os.makedirs(d, exist_ok=True)
+            shutil.move(str(self.input_path), 'delme')
+        instrument.count('bytes split', input_size)
+        return result
@@ -0,0 +1,573 @@
+#! /usr/bin/env python3
+"""
+On-disk stores kept under ~/.cache/screencap, shared between runs.
+
+Set SCREENCAP_CACHE_DIR to relocate them, or SCREENCAP_NO_CACHE=1 to disable.
+"""
+import logging
+logger = logging.getLogger(__name__)
+debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
+
+import hashlib
+import json
+import os, os.path
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from .util import *
+
+
+def get_cache_dir():
+    if os.environ.get('SCREENCAP_CACHE_DIR'):
+        return Path(os.environ['SCREENCAP_CACHE_DIR'])
+    xdg = os.environ.get('XDG_CACHE_HOME', None)
+    return (Path(xdg) if xdg else Path.home() / '.cache') / 'screencap'
+def connect(filename):
+    """
+    Open (creating if needed) a SQLite database in the cache folder.
+    """
+    folder = get_cache_dir()
+    folder.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(folder / filename), timeout=60, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+def file_identity(path):
+    """
+    (size, mtime_ns, inode) of a local file. Raises OSError if missing.
+    """
+    st = os.stat(str(path))
+    return st.st_size, st.st_mtime_ns, st.st_ino
+def fingerprint(*parts):
+    """
+    Digest of JSON-able parts, for comparing the inputs of an output.
+    """
+    text = json.dumps(parts, sort_keys=True, default=json_default)
+    return hashlib.sha1(text.encode()).hexdigest()
+def newer_than(path, sources):
+    """
+    make's rule: whether path exists, isn't empty, and was modified after
+    every source that is a local file.
+    """
+    try:
+        st = os.stat(str(path))
+    except OSError:
+        return False
+    if not st.st_size:
+        return False
+    for source in sources:
+        if (not source) or ('://' in str(source)):
+            continue
+        try:
+            if st.st_mtime_ns < os.stat(str(source)).st_mtime_ns:
+                return False
+        except OSError:
+            pass
+    return True
+
+
+class ProfileCache:
+    """
+    ffprobe results for local files, keyed on path and invalidated when the
+    file's size, mtime or inode change. Bounded to maxsize entries, dropping
+    the least-recently used.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS profiles (
+        path        TEXT PRIMARY KEY,
+        size        INTEGER NOT NULL,
+        mtime_ns    INTEGER NOT NULL,
+        ino         INTEGER NOT NULL,
+        last_used   REAL NOT NULL,
+        profile     TEXT NOT NULL );
+    CREATE INDEX IF NOT EXISTS profiles_last_used ON profiles (last_used);"""
+    def __init__(self, filename='media_profiles.sqlite', maxsize=250000):
+        self.filename, self.maxsize = filename, maxsize
+        self.lock = threading.Lock()
+        self.db = connect(filename)
+        with self.lock, self.db:
+            self.db.executescript(self.schema)
+        self.hits = self.misses = self.invalidations = 0
+    def __len__(self):
+        with self.lock:
+            n, = self.db.execute('SELECT COUNT(*) FROM profiles').fetchone()
+        return n
+    def get(self, path):
+        return self.get_many([path]).get(str(path), None)
+    def get_many(self, paths):
+        """
+        Returns { path: profile } for those paths with a valid entry.
+        """
+        found, stale = {}, []
+        t = time.time()
+        with self.lock, self.db:
+            for p in map(str, paths):
+                row = self.db.execute('SELECT size, mtime_ns, ino, profile FROM profiles WHERE path=?', (p,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    continue
+                try:
+                    ident = file_identity(p)
+                except OSError:
+                    ident = None
+                if ident != tuple(row[:3]):
+                    debug("'%s' changed on disk", p)
+                    stale.append((p,))
+                    self.invalidations += 1
+                    self.misses += 1
+                    continue
+                self.db.execute('UPDATE profiles SET last_used=? WHERE path=?', (t, p))
+                found[p] = json.loads(row[3])
+                self.hits += 1
+            if stale:
+                self.db.executemany('DELETE FROM profiles WHERE path=?', stale)
+        return found
+    def put(self, path, profile):
+        self.put_many({ path: profile })
+    def put_many(self, profiles):
+        t = time.time()
+        rows = []
+        for p, d in profiles.items():
+            try:
+                size, mtime_ns, ino = file_identity(p)
+            except OSError:
+                continue
+            rows.append((str(p), size, mtime_ns, ino, t, json.dumps(d)))
+        if rows:
+            with self.lock, self.db:
+                self.db.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.prune()
+    def discard(self, *paths):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM profiles WHERE path=?', [ (str(p),) for p in paths ])
+    def prune(self, maxsize=None):
+        """
+        Drop least-recently used entries beyond maxsize.
+        """
+        maxsize = self.maxsize if maxsize is None else maxsize
+        with self.lock, self.db:
+            n, = self.db.execute('SELECT COUNT(*) FROM profiles').fetchone()
+            if maxsize < n:
+                debug("Pruning %d cached profiles", n-maxsize)
+                self.db.execute('DELETE FROM profiles WHERE path IN (SELECT path FROM profiles ORDER BY last_used LIMIT ?)', (n-maxsize,))
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM profiles')
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations, 'entries': len(self) }
+
+
+class ContentIndex:
+    """
+    Which paths and URLs hold the same media, by content_key (see
+    ffprobe.content_key), with one profile per content and the outputs
+    already made from it. Locations are only as fresh as their last probe:
+    URLs probed more than max_age seconds ago are forgotten. Bounded to
+    maxsize locations, dropping the least-recently used, along with
+    contents and outputs no location refers to. Writes prune at most once
+    per prune_interval seconds.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS locations (
+        location    TEXT PRIMARY KEY,
+        content_key TEXT NOT NULL,
+        last_used   REAL NOT NULL,
+        probed      REAL NOT NULL DEFAULT 0 );
+    CREATE INDEX IF NOT EXISTS locations_content_key ON locations (content_key);
+    CREATE INDEX IF NOT EXISTS locations_last_used ON locations (last_used);
+    CREATE TABLE IF NOT EXISTS contents (
+        content_key TEXT PRIMARY KEY,
+        profile     TEXT NOT NULL );
+    CREATE TABLE IF NOT EXISTS outputs (
+        content_key TEXT NOT NULL,
+        kind        TEXT NOT NULL,
+        params      TEXT NOT NULL,
+        path        TEXT NOT NULL,
+        PRIMARY KEY (content_key, kind, params) );"""
+    def __init__(self, filename='contents.sqlite', maxsize=250000, max_age=30*24*3600, prune_interval=3600):
+        self.filename, self.maxsize, self.max_age = filename, maxsize, max_age
+        self.prune_interval, self.pruned = prune_interval, None
+        self.lock = threading.Lock()
+        self.db = connect(filename)
+        with self.lock, self.db:
+            columns = [ row[1] for row in self.db.execute('PRAGMA table_info(locations)') ]
+            if columns and ('probed' not in columns): # made before expiry
+                self.db.execute('ALTER TABLE locations ADD COLUMN probed REAL NOT NULL DEFAULT 0')
+            self.db.executescript(self.schema)
+    def put_many(self, profiles, key=None):
+        """
+        Record { location: profile }, using key(profile) for content_key.
+        Profiles without one are skipped.
+        """
+        if key is None:
+            from .ffprobe import content_key as key
+        t = time.time()
+        locations, contents = [], {}
+        for location, d in profiles.items():
+            k = key(d)
+            if k:
+                locations.append((str(location), k, t, t))
+                contents.setdefault(k, json.dumps(d, default=json_default))
+        if locations:
+            with self.lock, self.db:
+                self.db.executemany('INSERT OR REPLACE INTO locations (location, content_key, last_used, probed) VALUES (?, ?, ?, ?)', locations)
+                self.db.executemany('INSERT OR REPLACE INTO contents VALUES (?, ?)', contents.items())
+            if (self.pruned is None) or (self.prune_interval < t-self.pruned):
+                self.prune()
+    def _lookup(self, query, locations):
+        """
+        { location: first row of query } for known locations, skipping
+        expired URLs and marking the rest as used.
+        """
+        t = time.time()
+        found = {}
+        with self.lock, self.db:
+            for l in map(str, locations):
+                row = self.db.execute(query, (l, t-self.max_age)).fetchone()
+                if row:
+                    found[l] = row
+                    self.db.execute('UPDATE locations SET last_used=? WHERE location=?', (t, l))
+        return found
+    def get_keys(self, locations):
+        """
+        Returns { location: content_key } for known locations.
+        """
+        return { l: row[0] for l, row in self._lookup( \
+                'SELECT content_key FROM locations WHERE location=? ' \
+                "AND (? <= probed OR location NOT LIKE '%://%')", locations).items() }
+    def get_profiles(self, locations):
+        """
+        Returns { location: profile } for known locations. Copies share one
+        profile, so its format.filename is set to each location.
+        """
+        found = {}
+        for l, row in self._lookup( \
+                'SELECT profile FROM contents JOIN locations USING (content_key) WHERE location=? ' \
+                "AND (? <= probed OR location NOT LIKE '%://%')", locations).items():
+            d = found[l] = json.loads(row[0])
+            if 'format' in d:
+                d['format']['filename'] = l
+        return found
+    def get_locations(self, key):
+        with self.lock:
+            return [ row[0] for row in self.db.execute('SELECT location FROM locations WHERE content_key=? ORDER BY last_used DESC', (key,)) ]
+    def get_output(self, key, kind, params):
+        """
+        Path of an output already made from this content with these params,
+        if it still exists.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT path FROM outputs WHERE content_key=? AND kind=? AND params=?', (key, kind, params)).fetchone()
+        if row and os.path.isfile(row[0]) and os.path.getsize(row[0]):
+            return row[0]
+    def put_output(self, key, kind, params, path):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)', (key, kind, params, os.path.abspath(str(path))))
+    def clear(self):
+        with self.lock, self.db:
+            for table in ('locations', 'contents', 'outputs'):
+                self.db.execute('DELETE FROM '+table)
+    def prune(self, maxsize=None):
+        """
+        Drop expired URLs and least-recently used locations beyond maxsize,
+        then contents and outputs of no remaining location.
+        """
+        maxsize = self.maxsize if maxsize is None else maxsize
+        self.pruned = time.time()
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM locations WHERE probed < ? AND location LIKE '%://%'", (time.time()-self.max_age,))
+            n, = self.db.execute('SELECT COUNT(*) FROM locations').fetchone()
+            if maxsize < n:
+                debug("Pruning %d indexed locations", n-maxsize)
+                self.db.execute('DELETE FROM locations WHERE location IN (SELECT location FROM locations ORDER BY last_used LIMIT ?)', (n-maxsize,))
+            for table in ('contents', 'outputs'):
+                self.db.execute('DELETE FROM %s WHERE content_key NOT IN (SELECT content_key FROM locations)' % table)
+
+
+class LibraryIndex:
+    """
+    Probed attributes of the entries of every playlist indexed, for ranking
+    copies across a library without parsing or probing again. Playlists are
+    re-indexed when their file's size, mtime or inode change.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS playlists (
+        path        TEXT PRIMARY KEY,
+        size        INTEGER NOT NULL,
+        mtime_ns    INTEGER NOT NULL,
+        ino         INTEGER NOT NULL,
+        indexed     REAL NOT NULL );
+    CREATE TABLE IF NOT EXISTS entries (
+        playlist    TEXT NOT NULL REFERENCES playlists (path) ON DELETE CASCADE,
+        file_order  INTEGER NOT NULL,
+        location    TEXT NOT NULL,
+        title       TEXT,
+        content_key TEXT,
+        start_time  REAL,
+        stop_time   REAL,
+        ok          INTEGER NOT NULL,   -- from 'status'
+        checked     REAL,
+        width       INTEGER NOT NULL,
+        height      INTEGER NOT NULL,
+        bit_rate    INTEGER NOT NULL,
+        duration    REAL,
+        video_codec TEXT,
+        audio_codecs TEXT,
+        m3u         TEXT NOT NULL,
+        m3u_verbose TEXT NOT NULL,
+        PRIMARY KEY (playlist, file_order) );
+    CREATE INDEX IF NOT EXISTS entries_quality ON entries (ok DESC, width DESC, bit_rate DESC);
+    CREATE INDEX IF NOT EXISTS entries_content_quality ON entries (content_key, ok DESC, width DESC, bit_rate DESC);
+    CREATE INDEX IF NOT EXISTS entries_title_quality ON entries (title, ok DESC, width DESC, bit_rate DESC);
+    CREATE INDEX IF NOT EXISTS entries_playlist_quality ON entries (playlist, ok DESC, width DESC, bit_rate DESC);"""
+    # video_quality_key, in SQL
+    quality_order = 'ok DESC, width DESC, bit_rate DESC'
+    def __init__(self, filename='library.sqlite'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = connect(filename)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute('PRAGMA foreign_keys=ON')
+            self.db.executescript(self.schema)
+    def is_current(self, path):
+        """
+        Whether path was indexed since it last changed.
+        """
+        path = os.path.abspath(str(path))
+        try:
+            ident = file_identity(path)
+        except OSError:
+            return False
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime_ns, ino FROM playlists WHERE path=?', (path,)).fetchone()
+        return (row is not None) and (tuple(row) == ident)
+    def put_playlist(self, path, entries):
+        """
+        Replace the indexed entries of the playlist file at path. Local
+        entries are stored by absolute path, so the index can be queried from
+        any folder.
+        """
+        def to_float(t):
+            return None if (t is None) else float(t)
+        def get_location(e):
+            return e.url if e.remote else str(Path(e.path).resolve())
+        def to_m3u(e, **kwargs):
+            lines = list(e.to_m3u(**kwargs))
+            if lines and not e.remote: # the last line is the path
+                lines[-1] = get_location(e)
+            return '\n'.join(lines)
+        def to_m3us(e):
+            terse = to_m3u(e, verbose=False)
+            try:
+                return terse, to_m3u(e, verbose=True)
+            except KeyError: # verbose comments need codecs
+                return terse, terse
+        path = os.path.abspath(str(path))
+        size, mtime_ns, ino = file_identity(path)
+        rows = []
+        for e in entries:
+            status = e.get('status', (None, None))
+            duration = e.get_duration()
+            rows.append((path, e.get('lineno', 0) or 0, get_location(e), \
+                    e.get_title(), e.get('content_key', None), \
+                    to_float(e.get('start-time', None)), to_float(e.get('stop-time', None)), \
+                    1 if status[1] else 0, status[0].timestamp() if status[0] else None, \
+                    e.get('width', 0) or 0, e.get('height', 0) or 0, e.get('bit_rate', 0) or 0, \
+                    to_float(duration), e.get('video_codec', None), \
+                    ','.join(filter(None, e.get('audio_codecs', None) or [])) or None, \
+                    *to_m3us(e)))
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM playlists WHERE path=?', (path,))
+            self.db.execute('INSERT INTO playlists VALUES (?, ?, ?, ?, ?)', (path, size, mtime_ns, ino, time.time()))
+            self.db.executemany('INSERT INTO entries VALUES (%s)' % ', '.join('?'*17), rows)
+        debug("Indexed %d entries of '%s'", len(rows), path)
+    def sorted_playlist(self, path):
+        """
+        Rows of one playlist's entries, best quality first.
+        """
+        path = os.path.abspath(str(path))
+        with self.lock:
+            return self.db.execute('SELECT * FROM entries WHERE playlist=? ORDER BY '+self.quality_order, (path,)).fetchall()
+    def best_copies(self, n=1, keys=None, by='content_key', **where):
+        """
+        Rows of up to n best entries for each value of by ('content_key' or
+        'title'), optionally only those values in keys. By content_key, only
+        entries with the same start and stop times are copies, as in
+        playlist.find_duplicates, so scenes of one file aren't. where filters on
+        columns: width=1920 means width >= 1920, and other columns equality.
+        """
+        assert by in ('content_key', 'title')
+        clauses, args = [ '%s IS NOT NULL' % by ], []
+        if keys:
+            clauses.append('%s IN (%s)' % (by, ', '.join('?'*len(keys))))
+            args.extend(keys)
+        for column, value in where.items():
+            if column in ('width', 'height', 'bit_rate'):
+                clauses.append('%s >= ?' % column)
+            elif column in ('ok', 'video_codec', 'playlist'):
+                clauses.append('%s = ?' % column)
+            else:
+                raise ValueError(column)
+            args.append(value)
+        group = by+', start_time, stop_time' if (by == 'content_key') else by
+        query = """SELECT * FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY {order}) AS rank
+            FROM entries WHERE {where} )
+            WHERE rank <= ? ORDER BY {group}, rank""".format(group=group, order=self.quality_order, where=' AND '.join(clauses))
+        with self.lock:
+            return self.db.execute(query, args+[n]).fetchall()
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM playlists')
+
+
+class BuildJournal:
+    """
+    A make-style manifest: for each output made, a fingerprint of its inputs
+    (see fingerprint) and the output's size, mtime and inode when made. An
+    output is current while both are unchanged. Jobs record their outputs as
+    they finish, so an interrupted batch resumes where it stopped.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS outputs (
+        path        TEXT PRIMARY KEY,
+        kind        TEXT NOT NULL,
+        inputs      TEXT NOT NULL,
+        size        INTEGER NOT NULL,
+        mtime_ns    INTEGER NOT NULL,
+        ino         INTEGER NOT NULL,
+        made        REAL NOT NULL );"""
+    def __init__(self, filename='journal.sqlite'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = connect(filename)
+        with self.lock, self.db:
+            self.db.executescript(self.schema)
+    def get(self, path):
+        """
+        Recorded inputs fingerprint of path, or None if it isn't recorded or
+        has changed on disk since.
+        """
+        path = os.path.abspath(str(path))
+        with self.lock:
+            row = self.db.execute('SELECT inputs, size, mtime_ns, ino FROM outputs WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return None
+        try:
+            ident = file_identity(path)
+        except OSError:
+            ident = None
+        if ident != tuple(row[1:]):
+            debug("'%s' changed since it was made", path)
+            return None
+        return row[0]
+    def is_current(self, path, inputs):
+        """
+        Whether path was made from these inputs and is unchanged since. An
+        output never recorded is stale, even if newer than its sources: it
+        may be what a crashed job left half-written.
+        """
+        recorded = self.get(path)
+        return (recorded is not None) and (recorded == inputs)
+    def put(self, path, inputs, kind=''):
+        self.put_many({ path: inputs }, kind=kind)
+    def put_many(self, outputs, kind=''):
+        """
+        Record { output path: inputs fingerprint } for outputs that exist.
+        """
+        t = time.time()
+        rows = []
+        for p, inputs in outputs.items():
+            p = os.path.abspath(str(p))
+            try:
+                size, mtime_ns, ino = file_identity(p)
+            except OSError:
+                continue
+            rows.append((p, kind, inputs, size, mtime_ns, ino, t))
+        if rows:
+            with self.lock, self.db:
+                self.db.executemany('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    def discard(self, *paths):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM outputs WHERE path=?', [ (os.path.abspath(str(p)),) for p in paths ])
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM outputs')
+
+
+_profile_cache = None
+def get_profile_cache():
+    """
+    Shared ProfileCache, or None if disabled or the cache folder is unusable.
+    """
+    global _profile_cache
+    if os.environ.get('SCREENCAP_NO_CACHE'):
+        return None
+    if _profile_cache is None:
+        try:
+            _profile_cache = ProfileCache()
+        except (OSError, sqlite3.Error) as e:
+            warn("Persistent profile cache unavailable: %s", e)
+            _profile_cache = False
+    return _profile_cache if (_profile_cache is not False) else None
+
+
+_content_index = None
+def get_content_index():
+    """
+    Shared ContentIndex, or None if disabled or the cache folder is unusable.
+    """
+    global _content_index
+    if os.environ.get('SCREENCAP_NO_CACHE'):
+        return None
+    if _content_index is None:
+        try:
+            _content_index = ContentIndex()
+        except (OSError, sqlite3.Error) as e:
+            warn("Content index unavailable: %s", e)
+            _content_index = False
+    return _content_index or None
+
+
+_library_index = None
+def get_library_index():
+    """
+    Shared LibraryIndex, or None if disabled or the cache folder is unusable.
+    """
+    global _library_index
+    if os.environ.get('SCREENCAP_NO_CACHE'):
+        return None
+    if _library_index is None:
+        try:
+            _library_index = LibraryIndex()
+        except (OSError, sqlite3.Error) as e:
+            warn("Library index unavailable: %s", e)
+            _library_index = False
+    return _library_index or None
+
+
+_build_journal = None
+def get_build_journal():
+    """
+    Shared BuildJournal, or None if disabled or the cache folder is unusable.
+    """
+    global _build_journal
+    if os.environ.get('SCREENCAP_NO_CACHE'):
+        return None
+    if _build_journal is None:
+        try:
+            _build_journal = BuildJournal()
+        except (OSError, sqlite3.Error) as e:
+            warn("Build journal unavailable: %s", e)
+            _build_journal = False
+    return _build_journal or None
+def up_to_date(path, inputs, sources=()):
+    """
+    Whether output path is current for inputs, by the BuildJournal or,
+    only without one, by make's rule (see newer_than).
+    """
+    journal = get_build_journal()
+    if journal is None:
+        return newer_than(path, sources)
+    return journal.is_current(path, inputs)
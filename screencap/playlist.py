@@ -3,66 +3,135 @@ import logging
 logger = logging.getLogger(__name__)
 debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import itertools
-import os.path
+import os, os.path
+import shutil
+import threading
 import urllib.parse
 
-from .ffmpeg import get_screencap_commands
+from . import instrument
+from .ffmpeg import get_scenes_screencap_commands, get_screencap_commands
 from .ffprobe import get_media_profile, get_media_profiles
+from .jobs import Job, run_jobs
+from .labels import insert_screencap_defaults
 from .m3u import *
+from .persist import file_identity, fingerprint, get_build_journal, get_content_index, up_to_date
 
 from .util import *
 
+# requests is imported by the functions using it, only once a remote entry is
+# seen, so that local-only runs don't pay for it
 
-import requests
+remote_status_cache = Cache('remote_status', maxsize=100000)
 
-RequestException = requests.exceptions.RequestException
+
+def _check_urls(session, hostname, entries, failures_allowed=10, connections=4):
+    """
+    HEAD each entry on one host with up to `connections` requests in flight,
+    setting its 'status'. Stops issuing requests once failures_allowed is
+    exhausted; entries not attempted are left without a status. URLs already
+    checked by this process reuse their status from remote_status_cache.
+    """
+    from requests.exceptions import RequestException
+    lock = threading.Lock()
+    budget = [failures_allowed]
+    def check(e):
+        status = remote_status_cache.get(e.url, None)
+        if status:
+            e['status'] = status
+            return status[1]
+        with lock:
+            if not budget[0]:
+                return None
+        instrument.count('HEAD requests')
+        try:
+            ok = session.head(e.url).ok
+        except RequestException:
+            ok = False
+            with lock:
+                if budget[0]:
+                    budget[0] -= 1
+                    if not budget[0]:
+                        error("Too many failures on host %s", hostname)
+        e['status'] = remote_status_cache[e.url] = (now(), ok)
+        return ok
+    if connections <= 1:
+        return [ check(e) for e in entries ]
+    with ThreadPoolExecutor(max_workers=connections, \
+            thread_name_prefix=hostname) as executor:
+        return list(executor.map(check, entries))
+
+
+def _check_host(hostname, entries, failures_allowed=10, connections_per_host=4):
+    """
+    Check that a host is up, then set 'status' on its entries.
+    """
+    import requests
+    from requests.exceptions import RequestException
+    with requests.Session() as s:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, connections_per_host))
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        try:
+            s.head('http://%s/' % hostname)
+        except RequestException:
+            warn("Host %s not reachable", hostname)
+            failures_allowed = 1
+        if failures_allowed:
+            info("Host %s appears up", hostname)
+            with instrument.span('check_urls', host=hostname, entries=len(entries)):
+                _check_urls(s, hostname, entries, \
+                        failures_allowed=failures_allowed, \
+                        connections=connections_per_host)
+            info("Done with host %s", hostname)
+
+
+def _get_profile(e):
+    """
+    e's profile from its playlist's batch probe (see
+    M3U._precompute_metadata), or {} if that failed, so it isn't probed
+    again one at a time. None, to probe it, if it wasn't in a batch.
+    """
+    profiles = getattr(e.playlist, 'profiles', None) or {}
+    key = str(e.url if e.remote else e.path)
+    if key not in profiles:
+        return None
+    return profiles[key] or {}
 
 
 def _parse_entries(arg, \
         failures_allowed=10, \
+        connections_per_host=4, \
+        check=True, \
         VLC_custom_EXTINF=True, \
         VLC_custom_folders=True, \
         force_basename_in_output_filename=None):
     """
     Worker for parse_playlist()
 
+    With check=False, remote entries are assumed to have been checked (and
+    their metadata probed) already.
     """
     filename_or_hostname, is_remote, entries = arg
     #results = []
     #y = results.append
     if is_remote: # single host, with possibly multiple input files
         hostname = filename_or_hostname
-        with requests.Session() as s:
-            ok = None
-            try:
-                ok = s.head('http://%s/' % hostname).ok
-            except RequestException:
-                ok = False
-                warn("Host %s not reachable", hostname)
-                failures_allowed = 1
-            if failures_allowed:
-                info("Host %s appears up", hostname)
-                for e in entries:
-                    if not failures_allowed:
-                        error("Too many failures on host %s", hostname)
-                        break
-                    url = e.remote
-                    try:
-                        ok = s.head(url).ok
-                    except RequestException:
-                        failures_allowed -= 1
-                        ok = False
-                    e['status'] = (now(), ok)
-                    if ok:
-                        e.update_metadata()
-                else:
-                    info("Done with host %s", hostname)
+        if check:
+            _check_host(hostname, entries, \
+                    failures_allowed=failures_allowed, \
+                    connections_per_host=connections_per_host)
+        for e in entries:
+            if e.get('status', (None, False))[1]:
+                e.update_metadata(_get_profile(e))
     else: # single local input file
         path = filename_or_hostname
         filename = path.name
         for e in entries:
-            e.update_metadata()
+            e.update_metadata(_get_profile(e))
             e['status'] = (now(), path.exists())
     entries.sort(key=file_starttime_key)
     # Generate output names for further processing. These are filename-based.
@@ -101,16 +170,40 @@ def _parse_entries(arg, \
     return entries
 
 
-def parse_playlist(arg, nprocs=None):
+@instrument.traced()
+def parse_playlist(arg, nprocs=None, \
+        failures_allowed=10, connections_per_host=4, \
+        **kwargs):
     """
     Processes a M3U playlist, injecting values for title and duration for each entry.
+
+    Up to nprocs hosts (or local files) are processed concurrently. Remote
+    entries are first checked with HEAD requests, then those found are probed
+    together, at most connections_per_host at once on any host. Other keyword
+    arguments are passed to _parse_entries().
     """
     playlist = M3U(arg) # modified in-place
     info("Reading %d entries", len(playlist))
     playlist._precompute_metadata()
+    groups = list(playlist.by_host())
+    nthreads = nprocs or min(32, (os.cpu_count() or 1)+4)
+    remote_groups = [ (h, es) for h, is_remote, es in groups if is_remote ]
+    if remote_groups:
+        def check_worker(group):
+            hostname, entries = group
+            _check_host(hostname, entries, failures_allowed=failures_allowed, \
+                    connections_per_host=connections_per_host)
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(check_worker, remote_groups))
+        with instrument.span('probe remote entries'):
+            playlist._precompute_metadata(remote=True, nprocs=nthreads, \
+                    per_host=connections_per_host)
     es = []
-    for lre in playlist.by_host():
-        es.extend(_parse_entries(lre))
+    def worker(lre):
+        return _parse_entries(lre, check=False, **kwargs)
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        for results in executor.map(worker, groups):
+            es.extend(results)
     es.sort(key=file_order)
     for e in es:
         debug("Line %d '%s' -> %s", file_order(e), e.remote or e.path, e.keys())
@@ -118,24 +211,244 @@ def parse_playlist(arg, nprocs=None):
     return playlist
 
 
-def screencap_playlist(arg, **kwargs):
-    if isinstance(arg, M3U):
-        playlist = arg
+def find_duplicates(entries):
+    """
+    Returns { id(entry): original } for entries with the same content (see
+    ffprobe.content_key) and start and stop times as an earlier entry. Local
+    files count as earlier than URLs.
+    """
+    originals, duplicates = {}, {}
+    for e in sorted(entries, key=lambda e: (bool(e.remote), file_order(e))):
+        k = e.get('content_key', None)
+        if not k:
+            continue
+        k = k, e.get('start-time', None), e.get('stop-time', None)
+        if k in originals:
+            debug("'%s' duplicates '%s'", e.remote or e.path, originals[k].remote or originals[k].path)
+            duplicates[id(e)] = originals[k]
+        else:
+            originals[k] = e
+    return duplicates
+def screens_params(e):
+    "Identifies a screencap of e's content in ContentIndex.outputs"
+    return '%s-%s' % (e.get('start-time', ''), e.get('stop-time', ''))
+def input_identity(e):
+    "The size, mtime and inode of e's file, or for a URL its content_key"
+    if e.remote:
+        return e.get('content_key', None) or e.url
+    try:
+        return file_identity(e.path)
+    except OSError:
+        return None
+def input_sources(e):
+    "Files that outputs of e must be newer than, by make's rule"
+    return [ None if e.remote else e.path, getattr(e.playlist, 'path', None) ]
+def screens_inputs(e, layout='3x10', seek=False):
+    "Fingerprint of what e's screencap is made from, for the BuildJournal"
+    try:
+        md = insert_screencap_defaults(e.retrieve_metadata())
+    except KeyError: # not probed
+        labels = None
     else:
-        playlist_filename = arg
-        playlist = parse_playlist(playlist_filename, **kwargs)
-    if not len(playlist):
-        warning("Empty playlist")
-        return
-    failures = 0
+        labels = { k: md.get(k, None) for k in ('title', 'duration_label', 'quality_label', 'size_label') }
+    parts = [ input_identity(e), e.get('start-time', None), e.get('stop-time', None), layout, labels ]
+    if seek: # seeking grabs different frames
+        parts.append('seek')
+    return fingerprint('screens', *parts)
+def get_copy_commands(source, outputs):
+    "Generate lines of sh code copying one output to others"
+    for output in outputs:
+        yield 'mkdir -p %s && cp -- %s %s || echo %s >&2' % \
+                (sq(Path(str(output)).parent), sq(source), sq(output), sq('%s failed!' % output))
+
+
+def _composite(input_arg, e, copies=[], layout='3x10', seek=False):
+    "Job function making e's screencap in-process, then its copies"
+    from .composite import composite_screencap
+    output = composite_screencap(input_arg, e['screens_path'], \
+            insert_screencap_defaults(e.retrieve_metadata()), \
+            start=e.get('start-time', None), stop=e.get('stop-time', None), layout=layout, seek=seek)
+    if not output:
+        return 1
+    for c in copies:
+        Path(str(c)).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(str(output), str(c))
+    return 0
+
+
+def get_screencap_jobs(playlist, single_pass=False, dedup=True, produced=None, in_process=False, \
+        layout='3x10', force=False, seek=False):
+    """
+    Yields a Job running screencap.bash for each entry of a parsed playlist.
+
+    With single_pass=True, the scenes of an input with several entries are
+    captured by one Job that decodes the input once.
+
+    With dedup, an entry with the same content and times as another is copied
+    from its screencap instead, as is one already captured by an earlier run
+    (see persist.ContentIndex) unless force. Pass a dict as produced to collect { job name:
+    [ (content_key, params, output, inputs) ] } for recording outputs once run.
+
+    With in_process, single entries are captured by Python functions (see
+    composite.py) instead of scripts. Those Jobs can only be run, not printed.
+    With seek too, they grab each frame with an input seek rather than
+    decoding the whole input (see composite.seek_frames).
+
+    Unless force, entries whose screencap is up to date with their input,
+    times, layout and labels are skipped (see persist.up_to_date). Entries
+    without metadata (say, missing files) are skipped with a warning.
+    """
+    seek = seek and in_process
+    inputs = { id(e): screens_inputs(e, layout, seek=seek) for e in playlist if e.get('screens_path', None) }
+    current = set()
+    if not force:
+        for e in playlist:
+            if (id(e) in inputs) and \
+                    up_to_date(e['screens_path'], inputs[id(e)], input_sources(e)):
+                current.add(id(e))
+        if current:
+            info("%d screencaps are up to date", len(current))
+    stale = []
+    for e in playlist:
+        if id(e) in current:
+            continue
+        try:
+            e.retrieve_metadata()
+        except KeyError:
+            warn("Skipping '%s', which has no metadata", e.url if e.remote else e.path)
+            continue
+        stale.append(e)
+    stale_ids = set(map(id, stale))
+    index = get_content_index() if (dedup and not force) else None
+    journal = get_build_journal()
+    duplicates = find_duplicates(stale) if dedup else {}
+    copies = collections.defaultdict(list) # id(original): [ duplicate entries ]
+    for e in stale:
+        if (id(e) in duplicates) and e.get('screens_path', None):
+            copies[id(duplicates[id(e)])].append(e)
+    if copies:
+        info("%d duplicate entries will be copied", sum(len(v) for v in copies.values()))
+    def copy_paths(e):
+        return [ c['screens_path'] for c in copies.get(id(e), []) ]
+    def record(name, es):
+        if produced is not None:
+            es = es+[ c for e in es for c in copies.get(id(e), []) ]
+            produced[name] = [ (e.get('content_key', None), screens_params(e), e['screens_path'], inputs[id(e)]) \
+                               for e in es if id(e) in inputs ]
     for filename_or_host, is_remote, entries in playlist.by_host():
+        groups = collections.OrderedDict()
         for e in entries:
-            command_args = []
+            if (id(e) in duplicates) or (id(e) not in stale_ids):
+                continue
+            if index and e.get('content_key', None) and e.get('screens_path', None):
+                existing = index.get_output(e['content_key'], 'screens', screens_params(e))
+                if existing:
+                    outputs = [ p for p in [e['screens_path']]+copy_paths(e) \
+                                if os.path.abspath(str(p)) != existing ]
+                    record(e['screens_path'], [e])
+                    copies.pop(id(e), None)
+                    if journal and (os.path.abspath(str(e['screens_path'])) == existing):
+                        journal.put(existing, inputs[id(e)], kind='screens')
+                    if outputs:
+                        debug("Reusing '%s'", existing)
+                        yield Job(e['screens_path'], \
+                                script='\n'.join(get_copy_commands(existing, outputs)), \
+                                paths=[existing]+outputs)
+                    continue
+            input_arg = e.url if e.remote else e.path
+            groups.setdefault(str(input_arg) if single_pass else id(e), []).append(e)
+        for es in groups.values():
+            e = es[0]
+            input_arg = e.url if e.remote else e.path
+            if 1 < len(es):
+                scenes = []
+                for i, e in enumerate(es, start=1):
+                    scenes.append({ 'start-time': e.get('start-time', None),
+                                    'stop-time': e.get('stop-time', None),
+                                    'output': e.get('screens_path', None) or '%s-%03d.jpeg' % (Path(str(input_arg)).name, i),
+                                    'metadata': insert_screencap_defaults(e.retrieve_metadata()) })
+                with instrument.span('get_scenes_screencap_commands'):
+                    lines = list(get_scenes_screencap_commands(input_arg, scenes, layout=layout))
+                for e, scene in zip(es, scenes):
+                    lines.extend(get_copy_commands(scene['output'], copy_paths(e)))
+                record(str(input_arg), es)
+                yield Job(input_arg, script='\n'.join(lines), \
+                        paths=[ e.path for e in es ]+[ s['output'] for s in scenes ])
+                continue
+            if in_process and e.get('screens_path', None):
+                name = str(e['screens_path'])
+                record(name, [e])
+                yield Job(name, func=functools.partial(_composite, input_arg, e, copy_paths(e), layout=layout, seek=seek), \
+                        paths=[ e.path, e['screens_path'] ])
+                continue
+            command_args = [ '--' ]
+            if layout != '3x10':
+                command_args = [ '-s', layout ]+command_args
             if 'start-time' in e:
                 command_args += [ '-ss', e['start-time'] ]
-            command_args += [ '-i', e.remote or e.path ]
+            command_args += [ '-i', input_arg ]
             if 'stop-time' in e:
                 command_args += [ '-to', e['stop-time'] ]
-            for line in get_screencap_commands(*command_args, **e.retrieve_metadata()):
-                print(line)
-            print()
+            with instrument.span('get_screencap_commands'):
+                lines = list(get_screencap_commands(*command_args, \
+                        output=e.get('screens_path', None), \
+                        **insert_screencap_defaults(e.retrieve_metadata())))
+            if e.get('screens_path', None):
+                lines.extend(get_copy_commands(e['screens_path'], copy_paths(e)))
+            name = e.get('screens_path', None) or input_arg
+            record(str(name), [e])
+            yield Job(name, script='\n'.join(lines), \
+                    paths=[ e.path, e.get('screens_path', None) ])
+
+
+def record_outputs(results, produced, kind='screens'):
+    """
+    Record outputs of successful jobs (see get_screencap_jobs) in the
+    ContentIndex, for reuse, and in the BuildJournal, so reruns skip them.
+    """
+    index, journal = get_content_index(), get_build_journal()
+    for r in results:
+        if not r.ok:
+            continue
+        made = {}
+        for key, params, output, inputs in produced.get(r.name, []):
+            if os.path.isfile(str(output)):
+                if index and key:
+                    index.put_output(key, kind, params, output)
+                made[output] = inputs
+        if journal and made:
+            journal.put_many(made, kind=kind)
+
+
+def screencap_playlist(arg, run=False, nprocs=None, timeout=None, per_device=None, \
+        single_pass=False, in_process=None, layout='3x10', force=False, seek=False, **kwargs):
+    """
+    Print a screencap script for each entry of a playlist, or with run=True,
+    run them nprocs at a time (and per_device per disk) and return the
+    JobResults. single_pass=True decodes each input once for all of its
+    scenes. Screencaps made are recorded in the ContentIndex, for reuse.
+    When run, screencaps are composed in-process if Pillow is installed,
+    unless in_process=False, grabbing frames by seeking with seek=True.
+
+    Screencaps already up to date are skipped unless force. Each is recorded
+    in the BuildJournal as its job finishes, so an interrupted run resumes.
+    """
+    if isinstance(arg, M3U):
+        playlist = arg
+    else:
+        playlist_filename = arg
+        playlist = parse_playlist(playlist_filename, **kwargs)
+    if not len(playlist):
+        warn("Empty playlist")
+        return
+    produced = {}
+    if run and (in_process is None):
+        from .composite import available as in_process
+    jobs = get_screencap_jobs(playlist, single_pass=single_pass, produced=produced, \
+            in_process=(run and in_process), layout=layout, force=force, seek=seek)
+    if run:
+        return run_jobs(jobs, nprocs=nprocs, timeout=timeout, per_device=per_device, \
+                callback=lambda r: record_outputs([r], produced))
+    for job in jobs:
+        print(job.script)
+        print()
@@ -4,12 +4,15 @@ logger = logging.getLogger(__name__)
 debug, info, warn, error, panic = logger.debug, logger.info, logger.warn, logger.error, logger.critical
 
 import collections
-
-from . import *
+import shutil
+import time
 
 from .ffmpeg import FFMpegSplitter
-from .m3u import M3U
-from .mkvmerge import MkvMergeSplitter
+from .m3u import M3U, file_order
+from .jobs import Job, run_jobs
+from .mkvmerge import MkvMergeSplitter, SplitResult
+from .persist import fingerprint, get_build_journal, newer_than, up_to_date
+from .playlist import find_duplicates, get_copy_commands, input_identity, input_sources, parse_playlist
 
 from .util import *
 
@@ -38,15 +41,69 @@ class NullSplitter:
                     e.pop('intermediate_filename'), \
                     e['output_path'])
         yield 'EOF'
-    def to_script(self, head='#! /usr/bin/env bash\nset -e\n'):
+    def to_script(self, head='#! /usr/bin/env bash\nset -e\n', **kwargs):
         return head+'\n'.join(self.get_commands())+'\n'
         
 
+def split_inputs(e, profile):
+    "Fingerprint of what e's output is split from, for the BuildJournal"
+    return fingerprint('split', profile, input_identity(e), \
+            e.get('start-time', None), e.get('stop-time', None))
+def is_split(e, profile):
+    """
+    Whether e's output is up to date. Once split, a local input is moved
+    into delme/, so then an output that's unchanged since it was made counts.
+    """
+    output = e['output_path']
+    if e.remote or Path(e.path).exists():
+        return up_to_date(output, split_inputs(e, profile), input_sources(e))
+    journal = get_build_journal()
+    if journal is None:
+        return newer_than(output, [])
+    return journal.get(output) is not None
+
+
+def set_output_paths(entries):
+    """
+    Make output_path unique among entries, numbering those that would share
+    a name in the same folder (say, whole files of several URLs), and use
+    .MKV for what mkvmerge will write.
+    """
+    entries = sorted(entries, key=file_order)
+    for e in entries:
+        e['output_path'] = Path(e['output_path'])
+    names = collections.Counter( (e['output_path'].parent, e['output_path'].stem) for e in entries )
+    seen = collections.Counter()
+    for e in entries:
+        p = e['output_path']
+        _, ext = os.path.splitext(e.filename)
+        # local files are split by mkvmerge, see get_splitter
+        force_ext = '.MKV' if (not e.remote) and (ext.lower() in ['', '.mkv', '.mp4', '.webm']) else None
+        key = p.parent, p.stem
+        if 1 < names[key]:
+            seen[key] += 1
+            new_fp = '%s-%03d' % (p.stem, seen[key])
+            debug("Renaming %s -> %s", p.stem, new_fp)
+            e['output_path'] = p.parent/(new_fp+(force_ext or ext))
+        elif force_ext:
+            e['output_path'] = p.with_suffix(force_ext)
+
+
 def get_splitter(arg, \
         default_profiles=KVQ( [ ('(none)', NullSplitter) ] ), \
+        dedup=True, \
+        force=False, \
         **kwargs):
     """
     Yields at least one object with a .to_script() method.
+
+    With dedup, entries with the same content and times as another (say, a
+    URL of a local file) aren't split again; see playlist.find_duplicates.
+    Their outputs are copied from the other's, listed in the splitter's
+    .copies as [ (output, duplicate entry) ].
+
+    Unless force, entries whose output is up to date with their input and
+    times are left out (see persist.up_to_date).
     """
     if isinstance(arg, M3U):
         playlist = arg
@@ -55,34 +112,135 @@ def get_splitter(arg, \
         playlist = parse_playlist(playlist_filename)
 
     if not len(playlist):
-        warning("Empty playlist")
-        raise StopIteration
+        warn("Empty playlist")
+        return
+    duplicates = find_duplicates(playlist) if dedup else {}
+    copies = collections.defaultdict(list) # id(original): [ duplicate entries ]
+    for e in playlist:
+        if id(e) in duplicates:
+            copies[id(duplicates[id(e)])].append(e)
+    if duplicates:
+        info("Copying %d entries duplicating others", len(duplicates))
+    set_output_paths(list(playlist))
     for filename_or_hostname, is_remote, entries in playlist.by_host():
+        entries = [ e for e in entries if id(e) not in duplicates ]
+        if not entries:
+            continue
         profiles = KVQ(default_profiles)
         if is_remote:
-            basename = filename_or_hostname.path.rsplit('/', 1)[-1]
+            # ffmpeg seeks within URLs, so only the segments are downloaded
+            profiles['ffmpeg'] = FFMpegSplitter
+            groups = collections.OrderedDict()
+            for entry in entries:
+                groups.setdefault(entry.url, []).append(entry)
+            groups = list(groups.values())
         else:
             profiles['mkvmerge'] = MkvMergeSplitter
-            basename = filename_or_hostname.name
-            _, ext = os.path.splitext(basename)
-            force_ext = '.MKV' if ext.lower() in ['', '.mkv', '.mp4', '.webm'] else None
-            filenames = collections.Counter()
-            for entry in entries:
-                entry['output_path'] = Path(entry['output_path'])
-                fn = entry['output_path'].name
-                fp, _ = os.path.splitext(fn)
-                filenames[fp] += 1
-            for n, entry in enumerate(entries, start=1):
-                p = Path(entry['output_path'])
-                fn = p.name
-                fp, _ = os.path.splitext(fn)
-                if 1 < filenames[fp]:
-                    new_fp = '%s-%03d' % (fp, n)
-                    debug("Renaming %s -> %s", fp, new_fp)
-                    entry['output_path'] = p.parent/(new_fp+(force_ext or ext))
-                elif force_ext:
-                    entry['output_path'] = p.with_suffix(force_ext)
-        basename = clean_filename(basename)
+            groups = [ entries ]
         profile, splitter = profiles.get_latest()
         info("Using splitter %s", profile)
-        yield splitter(entries)
+        for entries in groups:
+            if not force:
+                # an original is only done once its copies are
+                done = set( id(e) for e in entries if is_split(e, profile) and \
+                            all(is_split(d, profile) for d in copies[id(e)]) )
+                if done:
+                    info("%d of %d outputs of '%s' are up to date", len(done), len(entries), \
+                            entries[0].url if is_remote else entries[0].path)
+                    entries = [ e for e in entries if id(e) not in done ]
+                    if not entries:
+                        continue
+            for entry in entries:
+                entry['split_inputs'] = split_inputs(entry, profile)
+                for d in copies[id(entry)]:
+                    d['split_inputs'] = split_inputs(d, profile)
+            s = splitter(entries)
+            s.copies = [ (e['output_path'], d) for e in entries for d in copies[id(e)] ]
+            yield s
+
+
+def get_split_script(splitter, **kwargs):
+    "splitter.to_script(), then copying outputs to duplicates (see get_splitter)"
+    lines = [ splitter.to_script(**kwargs) ]
+    for source, d in getattr(splitter, 'copies', []):
+        lines.extend(get_copy_commands(source, [ d['output_path'] ]))
+    return '\n'.join(lines)+'\n'
+def copy_outputs(splitter, result):
+    """
+    Copy outputs written by splitter to its duplicates, adding them to the
+    SplitResult.
+    """
+    for source, d in getattr(splitter, 'copies', []):
+        output = Path(str(d['output_path']))
+        if result.outputs.get(Path(str(source)), None) is None:
+            result.outputs[output] = None
+            continue
+        try:
+            output.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(str(source), str(output))
+            result.outputs[output] = output.stat().st_size
+        except OSError as e:
+            error("Copying to %s failed: %s", output, e)
+            result.outputs[output] = None
+
+
+def run_splitters(splitters, nprocs=None, timeout=None, per_device=None, **kwargs):
+    """
+    Run several splitters at once, nprocs at a time, returning SplitResults.
+    Splitters without a run() method are run as their scripts, so only their
+    exit status is known.
+
+    Each output written is recorded in the BuildJournal as soon as its
+    splitter finishes, so an interrupted batch resumes where it stopped.
+    """
+    journal = get_build_journal()
+    results = []
+    jobs, scripted = [], set()
+    for splitter in splitters:
+        if hasattr(splitter, 'run'):
+            def func(splitter=splitter):
+                begin = time.time()
+                try:
+                    r = splitter.run(timeout=timeout, **kwargs)
+                except Exception as e:
+                    error("Splitting '%s' failed: %s", splitter.input_path, e)
+                    outputs = collections.OrderedDict( (Path(str(entry['output_path'])), None) \
+                                                       for entry in splitter.entries )
+                    r = SplitResult(splitter.input_path, None, outputs, 1, time.time()-begin, \
+                            '%s: %s' % (type(e).__name__, e))
+                copy_outputs(splitter, r)
+                results.append(r)
+                if journal:
+                    inputs = { str(e['output_path']): e.get('split_inputs', None) \
+                               for e in splitter.entries+[ d for _, d in getattr(splitter, 'copies', []) ] }
+                    journal.put_many({ o: inputs[str(o)] for o, size in r.outputs.items() \
+                                       if (size is not None) and inputs.get(str(o), None) }, kind='split')
+                return 0 if r.ok else 1
+            jobs.append(Job(splitter.input_path, func=func, paths=splitter.paths))
+        else:
+            job = Job(getattr(splitter, 'input_filename', splitter), script=get_split_script(splitter), \
+                    paths=getattr(splitter, 'paths', ()))
+            scripted.add(job.name)
+            jobs.append(job)
+    for r in run_jobs(jobs, nprocs=nprocs, timeout=timeout, per_device=per_device):
+        if r.name in scripted:
+            results.append(SplitResult(r.name, None, {}, r.returncode, r.elapsed, r.message))
+    return results
+def summarize_splits(results, elapsed=None):
+    """
+    Generate lines of text describing a batch of SplitResults, with
+    throughput over elapsed wall-clock seconds.
+    """
+    outputs = [ (o, size) for r in results for o, size in r.outputs.items() ]
+    failed = [ o for o, size in outputs if size is None ]
+    bytes_read = sum(r.input_size or 0 for r in results)
+    yield '%d inputs, %d failed; %d outputs, %d failed' % \
+            (len(results), sum(1 for r in results if not r.ok), len(outputs), len(failed))
+    if elapsed:
+        yield '%.1f MB read, %.1f MB written in %.1f s: %.1f MB/s' % \
+                (bytes_read/1E6, sum(r.bytes_written for r in results)/1E6, elapsed, bytes_read/1E6/elapsed)
+    for r in results:
+        if r.message:
+            yield '  %s: %s' % (r.input_path, r.message)
+    for o in failed:
+        yield '  %s failed' % o
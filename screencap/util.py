@@ -1,11 +1,16 @@
 # intended to 'from .util import *'
 
-import collections
+import collections, collections.abc
 from datetime import datetime, timedelta
 import os, os.path
 from pathlib import Path
 import shlex
 import subprocess
+import sys
+import threading
+import types
+
+from . import instrument
 
 
 module_path, _ = os.path.split(__file__)
@@ -19,22 +24,143 @@ def sq(arg):
 
 def run(command, **kwargs):
     c = [ str(w) for w in command ]
-    return subprocess.run(c, **kwargs)
+    with instrument.span(os.path.basename(c[0]), category='subprocess', command=' '.join(c)):
+        return subprocess.run(c, **kwargs)
+
+def freeze(obj):
+    """
+    Read-only copy of parsed JSON: mappings become MappingProxyType and lists
+    become tuples.
+    """
+    if isinstance(obj, dict):
+        return types.MappingProxyType({ k: freeze(v) for k, v in obj.items() })
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+def json_default(obj):
+    """
+    For json.dumps(default=...), accepting frozen mappings and anything else
+    as its string.
+    """
+    if isinstance(obj, collections.abc.Mapping):
+        return dict(obj)
+    return str(obj)
 
 def time_s(n):
     if n is None:
         return ''
-    return str(timedelta(seconds=float(n))).strip(' :0')
+    t = str(timedelta(seconds=float(n)))
+    if '.' in t: # only fractional seconds lose trailing zeros
+        t = t.rstrip('0').rstrip('.')
+    return t.lstrip(' :0') or '0'
 
 class KVQ(collections.OrderedDict):
     def get_latest(self):
-        for k, v in self.items():
-            pass
-        return k, v
+        return next(reversed(self.items()))
+def approx_size(obj):
+    """
+    Rough number of bytes held by obj, following containers.
+    """
+    n = sys.getsizeof(obj)
+    if isinstance(obj, collections.abc.Mapping):
+        return n+sum(approx_size(k)+approx_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return n+sum(approx_size(v) for v in obj)
+    return n
+
+
+caches = {} # name: Cache
+_unchanged = object() # default of Cache.configure
+def cache_stats():
+    """
+    { name: statistics } for each named Cache.
+    """
+    return { name: c.stats() for name, c in caches.items() }
 class Cache(KVQ):
+    """
+    Least-recently-used mapping, bounded by maxsize entries and/or maxbytes
+    (as estimated by sizeof). Lookups by [] or get() count as hits or misses.
+    Caches given a name are listed in util.caches for inspection and tuning.
+    """
+    def __init__(self, name=None, maxsize=None, maxbytes=None, sizeof=approx_size):
+        super().__init__()
+        self.name, self.maxsize, self.maxbytes, self.sizeof = name, maxsize, maxbytes, sizeof
+        self.lock = threading.RLock()
+        self.sizes, self.nbytes = {}, 0
+        self.hits = self.misses = self.evictions = 0
+        if name:
+            caches[name] = self
+    def __repr__(self):
+        return '<Cache %s: %d entries>' % (self.name or '', len(self))
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                value = super().__getitem__(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self.move_to_end(key)
+            return value
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.nbytes -= self.sizes.pop(key, 0)
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            if self.maxbytes is not None:
+                size = self.sizes[key] = self.sizeof(value)
+                self.nbytes += size
+            self.evict()
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+            self.nbytes -= self.sizes.pop(key, 0)
+    def pop(self, key, *args):
+        with self.lock:
+            self.nbytes -= self.sizes.pop(key, 0)
+            return super().pop(key, *args)
+    def popitem(self, last=True):
+        with self.lock:
+            key, value = super().popitem(last=last)
+            self.nbytes -= self.sizes.pop(key, 0)
+            return key, value
+    def clear(self):
+        with self.lock:
+            super().clear()
+            self.sizes, self.nbytes = {}, 0
+    def evict(self):
+        with self.lock:
+            while self and ( \
+                    ((self.maxsize is not None) and (self.maxsize < len(self))) or \
+                    ((self.maxbytes is not None) and (self.maxbytes < self.nbytes)) ):
+                self.popitem(last=False)
+                self.evictions += 1
+    def configure(self, maxsize=_unchanged, maxbytes=_unchanged):
+        """
+        Set either bound, None meaning unbounded. A bound not given is kept.
+        """
+        with self.lock:
+            if maxsize is _unchanged:
+                maxsize = self.maxsize
+            if maxbytes is _unchanged:
+                maxbytes = self.maxbytes
+            if maxbytes is not None and self.maxbytes is None:
+                self.sizes = { k: self.sizeof(v) for k, v in self.items() }
+                self.nbytes = sum(self.sizes.values())
+            self.maxsize, self.maxbytes = maxsize, maxbytes
+            self.evict()
     def resize(self, newsize):
-        for _ in range(len(self)-newsize):
-            self.popitem(last=False)
+        self.configure(maxsize=newsize)
+    def stats(self):
+        return { 'entries': len(self), 'bytes': self.nbytes if (self.maxbytes is not None) else None, \
+                 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, \
+                 'maxsize': self.maxsize, 'maxbytes': self.maxbytes }
 
 
 def firange(*args):
@@ -61,19 +187,19 @@ def firange(*args):
 
 class HasTitle:
     """
+    Titles by source, in increasing precedence: the most recently added source
+    wins.
     """
+    __slots__ = ()
     def __init__(self, default_order=[], **kwargs):
         if isinstance(default_order, str):
             default_order = default_order.split()
-        self._ordered_titles = KVQ(( (k, None) for k in default_order))
+        self._ordered_titles = dict.fromkeys(default_order)
     def get_title(self, key=None):
         if key:
             return self._ordered_titles.get(key, None)
-        try:
-            k, v = self._ordered_titles.get_latest()
-            return v
-        except:
-            pass
+        if self._ordered_titles:
+            return self._ordered_titles[next(reversed(self._ordered_titles))]
     def set_title(self, *args):
         if len(args) == 1:
             return self.set_title(None, *args)
@@ -81,19 +207,19 @@ class HasTitle:
         self._ordered_titles[k] = v
 class HasDuration:
     """
+    Durations by source, in increasing precedence: the most recently added
+    source wins.
     """
+    __slots__ = ()
     def __init__(self, default_order=[], **kwargs):
         if isinstance(default_order, str):
-            default_order = _default_order.split()
-        self._ordered_durations = KVQ(( (k, None) for k in default_order))
+            default_order = default_order.split()
+        self._ordered_durations = dict.fromkeys(default_order)
     def get_duration(self, key=None):
         if key:
             return self._ordered_durations.get(key, None)
-        try:
-            k, v = self._ordered_durations.get_latest()
-            return v
-        except:
-            pass
+        if self._ordered_durations:
+            return self._ordered_durations[next(reversed(self._ordered_durations))]
     def set_duration(self, *args):
         if len(args) == 1:
             return self.set_duration(None, *args)
@@ -15,6 +15,7 @@ setup(name='PyScreencap',
               'screencap=screencap.cli:make_screencaps',
               'm3usplit=screencap.cli:make_split_script',
               'm3u_by_quality=screencap.cli:sort_playlist',
+              'm3u_query=screencap.cli:query_library',
               ]
           },
       package_data = {